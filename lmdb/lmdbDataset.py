@@ -1,243 +1,858 @@
 import os
+import re
 import json
 import lmdb
-import random
-import base64
+import zlib
+import math
+import pickle
+import time
+import queue
+import binascii
+import struct
 import threading
+import contextlib
+import concurrent.futures
 import cv2 as cv
 import numpy as np
 
+try:
+    import simplejpeg
+except ImportError:
+    simplejpeg = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class ReadWriteLock(object):
+    '''
+    A lock that can be held either by many readers or by a single writer.
+    Use "with lock.read:" and "with lock.write:". Waiting writers block new readers, so they are not starved;
+    as a consequence, the read side must not be acquired recursively.
+    '''
+    
+    class __Side(object):
+        __slots__ = ('acquire', 'release')
+        
+        def __init__(self, acquire, release):
+            self.acquire = acquire
+            self.release = release
+        
+        def __enter__(self):
+            self.acquire()
+        
+        def __exit__(self, exc_type, exc_value, exc_traceback):
+            self.release()
+    
+    def __init__(self):
+        self.__condition = threading.Condition(threading.Lock())
+        self.__readers = 0
+        self.__writing = False
+        self.__waitingWriters = 0
+        self.read = ReadWriteLock.__Side(self.acquireRead, self.releaseRead)
+        self.write = ReadWriteLock.__Side(self.acquireWrite, self.releaseWrite)
+    
+    def acquireRead(self):
+        with self.__condition:
+            while self.__writing or self.__waitingWriters > 0: self.__condition.wait()
+            self.__readers += 1
+    
+    def releaseRead(self):
+        with self.__condition:
+            self.__readers -= 1
+            if self.__readers == 0: self.__condition.notify_all()
+    
+    def acquireWrite(self):
+        with self.__condition:
+            self.__waitingWriters += 1
+            while self.__writing or self.__readers > 0: self.__condition.wait()
+            self.__waitingWriters -= 1
+            self.__writing = True
+    
+    def releaseWrite(self):
+        with self.__condition:
+            self.__writing = False
+            self.__condition.notify_all()
+
+
+class ImageJsonRecord(object):
+    '''
+    An image and a json read from the dataset, where the image is only decoded when first accessed,
+    so that reading the json alone does not pay for decoding the image.
+    '''
+    
+    __slots__ = ('__encodedImage', '__decodeImage', '__image', 'json')
+    
+    def __init__(self, encodedImage, decodeImage, j):
+        '''
+        Parameters:
+            encodedImage: The encoded image (a bytes object).
+            decodeImage: A function decoding the image.
+            j: The json (either a dictionary or an array).
+        '''
+        self.__encodedImage = encodedImage
+        self.__decodeImage = decodeImage
+        self.__image = None
+        self.json = j
+    
+    @property
+    def encodedImage(self):
+        return self.__encodedImage
+    
+    @property
+    def image(self):
+        '''
+        The image (a numpy/cv2 array), decoded on first access.
+        '''
+        if self.__image is None: self.__image = self.__decodeImage(self.__encodedImage)
+        return self.__image
+
 
 class LmdbSingleFileDataset(object):
     
     # Default map size (100 TB)
     DefaultMapSize = 100 * 1024 * 1024 * 1024 * 1024
+    
+    # Prefix of the values stored by storeDataJsonPair (a JSON text cannot start with a NUL byte,
+    # so values stored by older versions as base64 data inside a JSON are still recognized)
+    DataJsonPairMagic = b'\x00DJ1'
+    DataJsonPairHeader = struct.Struct('<4sQ')
+    
+    @staticmethod
+    def DumpJson(j):
+        '''
+        Serializes a json to compact ASCII bytes, like json.dumps: non-ASCII characters are escaped (so json values
+        can also be read with readString), NaN and infinities are stored as null, and numpy arrays and scalars are
+        stored as lists and numbers. orjson is used if available, otherwise the json module, which gives the same
+        output (floats aside, e.g. 1e-07 instead of 1e-7).
+        '''
+        if orjson is not None:
+            dump = orjson.dumps(j, default = LmdbSingleFileDataset.__JsonDefault, option = orjson.OPT_NON_STR_KEYS)
+            if dump.isascii(): return dump
+            return LmdbSingleFileDataset.__NonAsciiPattern.sub(LmdbSingleFileDataset.__EscapeNonAscii, dump.decode('utf-8')).encode('ascii')
+        try:
+            return json.dumps(j, separators = (',', ':'), allow_nan = False, default = LmdbSingleFileDataset.__JsonDefault).encode('ascii')
+        except ValueError:
+            # Only walked when the json contains NaN or infinities, to store them as null like orjson does
+            return json.dumps(LmdbSingleFileDataset.__NullNonFinite(j), separators = (',', ':'),
+                              default = LmdbSingleFileDataset.__JsonDefault).encode('ascii')
+    
+    @staticmethod
+    def __JsonDefault(o):
+        if isinstance(o, (np.ndarray, np.generic)): return o.tolist()
+        raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+    
+    @staticmethod
+    def __NullNonFinite(j):
+        if isinstance(j, (np.ndarray, np.generic)): j = j.tolist()
+        if isinstance(j, float): return j if math.isfinite(j) else None
+        if isinstance(j, dict): return { k: LmdbSingleFileDataset.__NullNonFinite(v) for k, v in j.items() }
+        if isinstance(j, (list, tuple)): return [ LmdbSingleFileDataset.__NullNonFinite(v) for v in j ]
+        return j
+    
+    # Non-ASCII characters can only be inside the strings of a json, so they are escaped wherever they are
+    __NonAsciiPattern = re.compile('[^\x00-\x7f]')
+    
+    @staticmethod
+    def __EscapeNonAscii(match):
+        c = ord(match.group())
+        if c < 0x10000: return '\\u{0:04x}'.format(c)
+        c -= 0x10000
+        return '\\u{0:04x}\\u{1:04x}'.format(0xd800 | (c >> 10), 0xdc00 | (c & 0x3ff))
+    
+    @staticmethod
+    def LoadJson(value):
+        '''
+        Parses a json from a bytes-like object (such as a memoryview of the memory map), with orjson if available.
+        '''
+        try:
+            if orjson is not None: return orjson.loads(value)
+            return json.loads(bytes(value))
+        except ValueError:
+            # Jsons stored as strings by storeString are latin1, which is not valid UTF-8 if they contain non-ASCII characters
+            return json.loads(str(value, 'latin1'))
+    
+    @staticmethod
+    def EncodeDataJsonPair(data, j):
+        '''
+        Encodes some data and a json as a single value: a header with the data length, the raw data and the json.
+        Parameters:
+            data: The data to encode (a bytes object).
+            j: The json to encode (a json - either a dictionary or an array).
+        Returns:
+            The encoded value (a bytes object).
+        '''
+        header = LmdbSingleFileDataset.DataJsonPairHeader.pack(LmdbSingleFileDataset.DataJsonPairMagic, len(data))
+        return b''.join((header, data, LmdbSingleFileDataset.DumpJson(j)))
+    
+    @staticmethod
+    def DecodeDataJsonPair(value):
+        '''
+        Decodes a value encoded by EncodeDataJsonPair (or by older versions, as base64 data inside a json).
+        Parameters:
+            value: The value to decode (a bytes-like object).
+        Returns:
+            A tuple containing:
+                1. The data (a slice of value, or a bytes object for older values).
+                2. The json (either a dictionary or an array).
+        '''
+        header = LmdbSingleFileDataset.DataJsonPairHeader
+        if value[:4] != LmdbSingleFileDataset.DataJsonPairMagic:
+            # Decoded straight from the value and from the base64 string, without intermediate copies
+            dataJsonPair = LmdbSingleFileDataset.LoadJson(value)
+            return binascii.a2b_base64(dataJsonPair["d"]), dataJsonPair["j"]
+        _, length = header.unpack_from(value)
+        end = header.size + length
+        return value[header.size:end], LmdbSingleFileDataset.LoadJson(value[end:])
+    
+    # Prefix of the values stored by storeArrayJsonPair, followed by the length of the pickle,
+    # the number of out-of-band buffers and their lengths (then the pickle and the buffers)
+    ArrayJsonPairMagic = b'\x00AJ1'
+    ArrayJsonPairHeader = struct.Struct('<4sQI')
+    
+    @staticmethod
+    def EncodeArrayJsonPair(array, j):
+        '''
+        Encodes a numpy array and a json as a single value, using pickle protocol 5 with out-of-band buffers,
+        so that the array data is copied only once (into the value) instead of being serialized.
+        Parameters:
+            array: The array to encode (a numpy array).
+            j: The json to encode (a json - either a dictionary or an array).
+        Returns:
+            The encoded value (a bytes object).
+        '''
+        buffers = []
+        pickled = pickle.dumps((np.ascontiguousarray(array), j), protocol = 5, buffer_callback = buffers.append)
+        buffers = [ b.raw() for b in buffers ]
+        header = LmdbSingleFileDataset.ArrayJsonPairHeader.pack(LmdbSingleFileDataset.ArrayJsonPairMagic, len(pickled), len(buffers))
+        lengths = struct.pack('<{}Q'.format(len(buffers)), *(b.nbytes for b in buffers))
+        return b''.join([ header, lengths, pickled ] + buffers)
+    
+    @staticmethod
+    def DecodeArrayJsonPair(value):
+        '''
+        Decodes a value encoded by EncodeArrayJsonPair. Only decode values from trusted datasets, as they are unpickled.
+        Parameters:
+            value: The value to decode (a bytes-like object).
+        Returns:
+            A tuple containing:
+                1. The array (a numpy array owning a copy of its data).
+                2. The json (either a dictionary or an array).
+        '''
+        header = LmdbSingleFileDataset.ArrayJsonPairHeader
+        magic, pickleLength, buffersCount = header.unpack_from(value)
+        if magic != LmdbSingleFileDataset.ArrayJsonPairMagic: raise Exception("The value was not stored as an array and a json")
+        lengths = struct.unpack_from('<{}Q'.format(buffersCount), value, header.size)
+        offset = header.size + 8 * buffersCount
+        pickled = value[offset:offset + pickleLength]
+        offset += pickleLength
+        buffers = []
+        for length in lengths:
+            buffers.append(bytearray(value[offset:offset + length]))
+            offset += length
+        return pickle.loads(pickled, buffers = buffers)
+    
+    @staticmethod
+    def __EncodeKey(key):
+        return key if type(key) is bytes else key.encode('latin1')
+    
+    @staticmethod
+    def __DecodeDataJsonPairCopy(value):
+        data, j = LmdbSingleFileDataset.DecodeDataJsonPair(value)
+        return bytes(data), j
+    
+    @staticmethod
+    def EncodeImage(image, imageFormat = ".jpg", jpegQuality = 95, colorspace = 'BGR'):
+        '''
+        Encodes an image the way the store methods do. It takes no lock, so it can be called
+        from many threads to encode images before storing them (OpenCV and simplejpeg release the GIL).
+        Parameters:
+            image: The image to encode (as a numpy/cv2 array).
+            imageFormat: Format with which to encode the image (cv2 string).
+            jpegQuality, colorspace: As in the constructor.
+        Returns:
+            The encoded image (a bytes object).
+        '''
+        isColor = image.ndim == 3 and image.shape[2] == 3
+        isJpeg = imageFormat.lower() in ('.jpg', '.jpeg')
+        if simplejpeg is not None and isJpeg and isColor and image.dtype == np.uint8:
+            # 4:2:0 chroma subsampling, like OpenCV, so that the stored images are the same size with either encoder
+            return simplejpeg.encode_jpeg(np.ascontiguousarray(image), quality = jpegQuality, colorspace = colorspace,
+                                          colorsubsampling = '420')
+        if isColor and colorspace == 'RGB': image = cv.cvtColor(image, cv.COLOR_RGB2BGR)
+        success, encodedImage = cv.imencode(imageFormat, image, [cv.IMWRITE_JPEG_QUALITY, jpegQuality] if isJpeg else [])
+        if not success: raise Exception("Failed to encode image")
+        return encodedImage.tobytes()
+    
+    def __encodeImage(self, image, imageFormat):
+        return LmdbSingleFileDataset.EncodeImage(image, imageFormat, self.__jpegQuality, self.__colorspace)
+    
+    # OpenCV flags decoding images at 1/reduce of their size (JPEGs are downscaled while being decoded)
+    ReducedImreadFlags = { 2: cv.IMREAD_REDUCED_COLOR_2, 4: cv.IMREAD_REDUCED_COLOR_4, 8: cv.IMREAD_REDUCED_COLOR_8 }
+    
+    @staticmethod
+    def DecodeImage(encodedImage, colorspace = 'BGR', reduce = 1):
+        '''
+        Decodes an image encoded by EncodeImage, with simplejpeg for colour JPEGs if available.
+        Parameters:
+            encodedImage: The encoded image (a bytes-like object, such as a memoryview of the memory map).
+            colorspace: As in the constructor.
+            reduce: 1 to decode the image at full size, or 2, 4 or 8 to decode it at 1/reduce of its size
+                (as a 3 channel colour image), which is much faster for JPEGs.
+        Returns:
+            The decoded image (a numpy/cv2 array).
+        '''
+        if reduce == 1:
+            if simplejpeg is not None and encodedImage[:2] == b'\xff\xd8':
+                _, _, jpegColorspace, _ = simplejpeg.decode_jpeg_header(encodedImage)
+                if jpegColorspace in ('YCbCr', 'RGB'): return simplejpeg.decode_jpeg(encodedImage, colorspace = colorspace)
+            image = cv.imdecode(np.frombuffer(encodedImage, np.uint8), -1)
+        else:
+            flags = LmdbSingleFileDataset.ReducedImreadFlags.get(reduce)
+            if flags is None: raise Exception("The image can only be reduced by 2, 4 or 8")
+            image = cv.imdecode(np.frombuffer(encodedImage, np.uint8), flags)
+        if colorspace == 'RGB' and image is not None and image.ndim == 3 and image.shape[2] == 3:
+            image = cv.cvtColor(image, cv.COLOR_BGR2RGB)
+        return image
+    
+    def __decodeImage(self, encodedImage):
+        return LmdbSingleFileDataset.DecodeImage(encodedImage, self.__colorspace)
+    
+    def __decodeImageJsonPair(self, value):
+        encodedImage, j = LmdbSingleFileDataset.DecodeDataJsonPair(value)
+        return self.__decodeImage(encodedImage), j
+    
+    def __decodeImageJsonRecord(self, value):
+        encodedImage, j = LmdbSingleFileDataset.DecodeDataJsonPair(value)
+        return ImageJsonRecord(bytes(encodedImage), self.__decodeImage, j)
 
-    def __init__(self, path, mapSize = None, readOnly = False):
-        self.__lock = threading.Lock()
+    def __init__(self, path, mapSize = None, readOnly = False, writemap = False, noSync = False, noMetaSync = False, mapAsync = False, noReadAhead = False,
+                 jpegQuality = 95, colorspace = 'BGR'):
+        '''
+        Parameters:
+            path: The directory of the LMDB file.
+            mapSize: The maximum size of the LMDB file.
+            readOnly: Whether to open the LMDB file in read-only mode (without the lock file, so there must be no concurrent writers).
+            writemap: Whether to write directly to the memory map instead of using write() syscalls.
+            noSync: Whether to skip flushing to disk on each commit. Meant for bulk ingests: the file is flushed once when closed,
+                but a system crash in the meantime may lose (or, with writemap, corrupt) the last commits.
+            noMetaSync: Whether to skip flushing the meta page on each commit.
+            mapAsync: Whether to flush asynchronously when writemap is used.
+            noReadAhead: Whether to disable OS readahead (useful for random reads on files larger than RAM).
+            jpegQuality: The quality of the JPEG images stored by storeImage and storeImageJsonPair.
+            colorspace: The channel order of the images passed to and returned by this dataset ('BGR' or 'RGB').
+        JPEG images are encoded and decoded with simplejpeg (libjpeg-turbo) when it is installed, otherwise with OpenCV.
+        '''
+        if colorspace not in ('BGR', 'RGB'): raise Exception("The colorspace must be either 'BGR' or 'RGB'")
+        self.__lock = ReadWriteLock()
         self.__path = path
         self.__mapSize = LmdbSingleFileDataset.DefaultMapSize if mapSize is None else mapSize
         self.__lmdbEnv = None
         self.__readOnly = readOnly
+        self.__writemap = writemap
+        self.__noSync = noSync
+        self.__noMetaSync = noMetaSync
+        self.__mapAsync = mapAsync
+        self.__noReadAhead = noReadAhead
+        self.__jpegQuality = jpegQuality
+        self.__colorspace = colorspace
+        self.__batch = threading.local()
+        self.__batchThread = None
+        self.__reader = threading.local()
+        # The read transactions cached by the threads, so that writers can release them (see __noLock_releaseReadTransactions)
+        self.__readTransactions = set()
+        # Incremented whenever the environment is opened or the read transactions are released, so that
+        # the long-lived read transactions of each thread know they have to be renewed
+        self.__generation = 0
     
     def __enter__(self):
         self.__open()
         return self
     
     def __exit__(self, exc_type, exc_value, exc_traceback):
-        self.__close()
+        with self.__lock.write:
+            if self.isBatching(): self.__noLock_endBatch(exc_type is None)
+            self.__noLock_close()
     
     def path(self):
-        with self.__lock: return self.__path
+        with self.__lock.read: return self.__path
     
     def __noLock_open(self):
         if not self.__lmdbEnv is None: raise Exception("The LMDB dataset has already been opened")
-        self.__lmdbEnv = lmdb.open(self.__path, map_size = self.__mapSize)
+        if self.__readOnly:
+            self.__lmdbEnv = lmdb.open(self.__path, map_size = self.__mapSize, readonly = True, lock = False,
+                                       readahead = not self.__noReadAhead)
+        else:
+            self.__lmdbEnv = lmdb.open(self.__path, map_size = self.__mapSize, writemap = self.__writemap,
+                                       sync = not self.__noSync, metasync = not self.__noMetaSync,
+                                       map_async = self.__mapAsync, readahead = not self.__noReadAhead)
+        self.__generation += 1
+        self.__noLock_installFastPaths()
     
     def __open(self):
-        with self.__lock: self.__noLock_open()
+        with self.__lock.write: self.__noLock_open()
             
     def __noLock_close(self):
         if not self.__lmdbEnv is None:
+            if self.__batchThread is not None: raise Exception("A batch is still in progress")
+            self.__noLock_releaseReadTransactions()
+            if not self.__readOnly and (self.__noSync or self.__noMetaSync or self.__mapAsync): self.__lmdbEnv.sync(True)
             self.__lmdbEnv.close()
             self.__lmdbEnv = None
+            for name in LmdbSingleFileDataset.__FastPaths: self.__dict__.pop(name, None)
             
     def __close(self):
-        with self.__lock: self.__noLock_close()
+        with self.__lock.write: self.__noLock_close()
     
     def __noLock_keys(self):
         if self.__lmdbEnv is None: raise Exception("The LMDB environment has not been initialized")
         with self.__lmdbEnv.begin() as transaction:
-            return [ key.decode('latin1') for key, _ in transaction.cursor() ]
+            return [ key.decode('latin1') for key in transaction.cursor().iternext(keys = True, values = False) ]
     
     def keys(self):
-        with self.__lock: return self.__noLock_keys()
+        with self.__lock.read: return self.__noLock_keys()
+    
+    def iterKeys(self):
+        '''
+        Iterates over the keys of the dataset (as they are when the iteration starts), without reading
+        the values nor building a list. The lock is not held between keys, so do not close the dataset while iterating.
+        '''
+        with self.__lock.read:
+            if self.__lmdbEnv is None: raise Exception("The LMDB environment has not been initialized")
+            transaction = self.__lmdbEnv.begin()
+        with transaction:
+            for key in transaction.cursor().iternext(keys = True, values = False): yield key.decode('latin1')
+    
+    def __noLock_batchTransaction(self):
+        '''
+        Returns the write transaction of the batch started by the calling thread, or None.
+        Raises an exception if a batch is in progress on another thread, since LMDB only
+        allows one write transaction at a time and waiting for it would deadlock.
+        '''
+        transaction = getattr(self.__batch, 'transaction', None)
+        if transaction is None and self.__batchThread is not None:
+            raise Exception("A batch is in progress on another thread")
+        return transaction
+    
+    def __noLock_beginBatch(self):
+        if self.__readOnly: raise Exception("The LMDB dataset has been opened in read-only mode")
+        if self.__lmdbEnv is None: raise Exception("The LMDB environment has not been initialized")
+        if self.__noLock_batchTransaction() is not None: raise Exception("A batch is already in progress")
+        self.__noLock_releaseReadTransactions()
+        self.__batch.transaction = self.__lmdbEnv.begin(write = True)
+        self.__batchThread = threading.get_ident()
+    
+    def beginBatch(self):
+        '''
+        Starts a batch: every following store on the calling thread is written in a single
+        LMDB transaction, until commitBatch() or abortBatch() is called.
+        '''
+        with self.__lock.write: self.__noLock_beginBatch()
+    
+    def __noLock_endBatch(self, commit):
+        transaction = self.__noLock_batchTransaction()
+        if transaction is None: raise Exception("No batch is in progress")
+        self.__batch.transaction = None
+        self.__batchThread = None
+        if commit:
+            transaction.commit()
+            self.__noLock_releaseReadTransactions()
+        else:
+            transaction.abort()
+    
+    def commitBatch(self):
+        '''
+        Commits the batch started by the calling thread.
+        '''
+        with self.__lock.write: self.__noLock_endBatch(True)
+    
+    def abortBatch(self):
+        '''
+        Discards everything stored in the batch started by the calling thread.
+        '''
+        with self.__lock.write: self.__noLock_endBatch(False)
+    
+    def isBatching(self):
+        '''
+        Returns True if the calling thread has a batch in progress.
+        '''
+        return getattr(self.__batch, 'transaction', None) is not None
+    
+    @contextlib.contextmanager
+    def batch(self):
+        '''
+        Context manager wrapping beginBatch() and commitBatch() (or abortBatch() on errors).
+        '''
+        self.beginBatch()
+        try:
+            yield self
+        except:
+            if self.isBatching(): self.abortBatch()
+            raise
+        self.commitBatch()
+    
+    def __noLock_storeMany(self, items):
+        '''
+        Stores many entries in the dataset with a single cursor.putmulti() call.
+        Parameters:
+            items: The (key, data) pairs to store (strings or latin1-encoded bytes objects, and bytes objects).
+        Returns:
+            The number of entries added.
+        '''
+        if self.__readOnly: raise Exception("The LMDB dataset has been opened in read-only mode")
+        if self.__lmdbEnv is None: raise Exception("The LMDB environment has not been initialized")
+        items = list(items)
+        if __debug__:
+            for key, data in items:
+                if not type(key) in (str, bytes): raise Exception("The provided key is neither a string nor a bytes object")
+                if not type(data) is bytes: raise Exception("The provided data is not a bytes object")
+        pairs = [ (LmdbSingleFileDataset.__EncodeKey(key), data) for key, data in items ]
+        transaction = self.__noLock_batchTransaction()
+        if transaction is not None:
+            _, added = transaction.cursor().putmulti(pairs, overwrite = False, append = False)
+            if added != len(pairs): raise Exception("Key already exists")
+            return added
+        self.__noLock_releaseReadTransactions()
+        with self.__lmdbEnv.begin(write = True) as transaction:
+            _, added = transaction.cursor().putmulti(pairs, overwrite = False, append = False)
+            # Raising inside the with block aborts the transaction, so nothing is stored
+            if added != len(pairs): raise Exception("Key already exists")
+        return added
+    
+    def storeMany(self, items):
+        '''
+        Stores many entries in the dataset with a single cursor.putmulti() call.
+        Existing keys are not overwritten: if a key already exists (or is repeated), an exception is raised
+        and nothing is stored (in a batch, the other entries are, until the batch is aborted).
+        Parameters:
+            items: The (key, data) pairs to store (strings or latin1-encoded bytes objects, and bytes objects).
+        Returns:
+            The number of entries added.
+        '''
+        with self.__lock.write: return self.__noLock_storeMany(items)
     
     def __noLock_storeData(self, key, data):
         '''
         Stores some data in the dataset.
         Parameters:
-            key: The key to associate with the data (a string).
+            key: The key to associate with the data (a string, or a bytes object if already encoded as latin1).
             data: The data to store (a bytes object).
         '''
         if self.__readOnly: raise Exception("The LMDB dataset has been opened in read-only mode")
-        if not type(key) is str: raise Exception("The provided key is not a string")
-        if not type(data) is bytes: raise Exception("The provided data is not a bytes object")
+        if __debug__:
+            if not type(key) in (str, bytes): raise Exception("The provided key is neither a string nor a bytes object")
+            if not type(data) is bytes: raise Exception("The provided data is not a bytes object")
         if self.__lmdbEnv is None: raise Exception("The LMDB environment has not been initialized")
+        transaction = self.__noLock_batchTransaction()
+        if transaction is not None:
+            transaction.put(LmdbSingleFileDataset.__EncodeKey(key), data)
+            return
+        self.__noLock_releaseReadTransactions()
         with self.__lmdbEnv.begin(write = True) as transaction:
-            transaction.put(key.encode('latin1'), data)
+            transaction.put(LmdbSingleFileDataset.__EncodeKey(key), data)
     
     def storeData(self, key, data):
         '''
         Stores some data in the dataset.
         Parameters:
-            key: The key to associate with the data (a string).
+            key: The key to associate with the data (a string, or a bytes object if already encoded as latin1).
             data: The data to store (a bytes object).
         '''
-        with self.__lock: self.__noLock_storeData(key, data)
+        with self.__lock.write: self.__noLock_storeData(key, data)
     
     def __noLock_storeString(self, key, s):
         '''
         Stores some data in the dataset.
         Parameters:
-            key: The key to associate with the data (a string).
+            key: The key to associate with the data (a string, or a bytes object if already encoded as latin1).
             s: The data to store (a string).
         '''
-        if not type(key) is str: raise Exception("The provided key is not a string")
-        if not type(s) is str: raise Exception("The provided data is not a string")
+        if __debug__:
+            if not type(key) in (str, bytes): raise Exception("The provided key is neither a string nor a bytes object")
+            if not type(s) is str: raise Exception("The provided data is not a string")
         self.__noLock_storeData(key, s.encode('latin1'))
     
     def storeString(self, key, s):
         '''
         Stores some data in the dataset.
         Parameters:
-            key: The key to associate with the data (a string).
+            key: The key to associate with the data (a string, or a bytes object if already encoded as latin1).
             s: The data to store (a string).
         '''
-        with self.__lock: self.__noLock_storeString(key, s)
+        with self.__lock.write: self.__noLock_storeString(key, s)
     
     def __noLock_storeJson(self, key, j):
         '''
         Stores some data in the dataset.
         Parameters:
-            key: The key to associate with the data (a string).
+            key: The key to associate with the data (a string, or a bytes object if already encoded as latin1).
             j: The data to store (a json - either a dictionary or an array).
         '''
-        if not type(key) is str: raise Exception("The provided key is not a string")
-        self.__noLock_storeString(key, json.dumps(j))
+        if __debug__:
+            if not type(key) in (str, bytes): raise Exception("The provided key is neither a string nor a bytes object")
+        self.__noLock_storeData(key, LmdbSingleFileDataset.DumpJson(j))
     
     def storeJson(self, key, j):
         '''
         Stores some data in the dataset.
         Parameters:
-            key: The key to associate with the data (a string).
+            key: The key to associate with the data (a string, or a bytes object if already encoded as latin1).
             j: The data to store (a json - either a dictionary or an array).
         '''
-        with self.__lock: self.__noLock_storeJson(key, j)
-    
-    def __noLock_storeImage(self, key, image, imageFormat = ".jpg"):
-        '''
-        Stores an image in the dataset.
-        Parameters:
-            key: The key to associate with the data (a string).
-            image: The image to store (as a numpy/cv2 array).
-            imageFormat: Format with which to encode the image (cv2 string).
-        '''
-        success, encodedImage = cv.imencode(imageFormat, image)
-        if not success: raise Exception("Failed to encode image")
-        self.__noLock_storeData(key, encodedImage.tobytes())
+        with self.__lock.write: self.__noLock_storeJson(key, j)
     
     def storeImage(self, key, image, imageFormat = ".jpg"):
         '''
         Stores an image in the dataset.
         Parameters:
-            key: The key to associate with the data (a string).
+            key: The key to associate with the data (a string, or a bytes object if already encoded as latin1).
             image: The image to store (as a numpy/cv2 array).
             imageFormat: Format with which to encode the image (cv2 string).
         '''
-        with self.__lock: self.__noLock_storeImage(key, image, imageFormat = imageFormat)
+        encodedImage = self.__encodeImage(image, imageFormat)
+        with self.__lock.write: self.__noLock_storeData(key, encodedImage)
     
     def __noLock_storeDataJsonPair(self, key, data, j):
         '''
         Stores some data and a json in the dataset.
         Parameters:
-            key: The key to associate with the data (a string).
+            key: The key to associate with the data (a string, or a bytes object if already encoded as latin1).
             data: The data to store (a bytes object).
             j: The json to store (a json - either a dictionary or an array).
         '''
-        if not type(key) is str: raise Exception("The provided key is not a string")
-        if not type(data) is bytes: raise Exception("The provided data is not a bytes object")
-        dataJsonPair = { "d": base64.encodebytes(data).decode('ascii'), "j": j }
-        self.__noLock_storeJson(key, dataJsonPair)
+        if __debug__:
+            if not type(key) in (str, bytes): raise Exception("The provided key is neither a string nor a bytes object")
+            if not type(data) is bytes: raise Exception("The provided data is not a bytes object")
+        self.__noLock_storeData(key, LmdbSingleFileDataset.EncodeDataJsonPair(data, j))
     
     def storeDataJsonPair(self, key, data, j):
         '''
         Stores some data and a json in the dataset.
         Parameters:
-            key: The key to associate with the data (a string).
+            key: The key to associate with the data (a string, or a bytes object if already encoded as latin1).
             data: The data to store (a bytes object).
             j: The json to store (a json - either a dictionary or an array).
         '''
-        with self.__lock: self.__noLock_storeDataJsonPair(key, data, j)
+        with self.__lock.write: self.__noLock_storeDataJsonPair(key, data, j)
+    
+    def storeArrayJsonPair(self, key, array, j):
+        '''
+        Stores a numpy array and a json in the dataset (see EncodeArrayJsonPair).
+        Parameters:
+            key: The key to associate with the data (a string, or a bytes object if already encoded as latin1).
+            array: The array to store (a numpy array).
+            j: The json to store (a json - either a dictionary or an array).
+        '''
+        value = LmdbSingleFileDataset.EncodeArrayJsonPair(array, j)
+        with self.__lock.write: self.__noLock_storeData(key, value)
     
     def __noLock_storeStringJsonPair(self, key, s, j):
         '''
         Stores some data and a json in the dataset.
         Parameters:
-            key: The key to associate with the data (a string).
+            key: The key to associate with the data (a string, or a bytes object if already encoded as latin1).
             s: The string to store (a string).
             j: The json to store (a json - either a dictionary or an array).
         '''
-        if not type(key) is str: raise Exception("The provided key is not a string")
-        if not type(s) is str: raise Exception("The provided data is not a string")
+        if __debug__:
+            if not type(key) in (str, bytes): raise Exception("The provided key is neither a string nor a bytes object")
+            if not type(s) is str: raise Exception("The provided data is not a string")
         self.__noLock_storeDataJsonPair(key, s.encode('latin1'), j)
     
     def storeStringJsonPair(self, key, s, j):
         '''
         Stores some data and a json in the dataset.
         Parameters:
-            key: The key to associate with the data (a string).
+            key: The key to associate with the data (a string, or a bytes object if already encoded as latin1).
             data: The string to store (a string).
             j: The json to store (a json - either a dictionary or an array).
         '''
-        with self.__lock: self.__noLock_storeStringJsonPair(key, s, j)
-    
-    def __noLock_storeImageJsonPair(self, key, image, j, imageFormat = ".jpg"):
-        '''
-        Stores an image and a json in the dataset.
-        Parameters:
-            key: The key to associate with the data (a string).
-            image: The image to store (a numpy/cv2 array).
-            j: The json to store (a json - either a dictionary or an array).
-            imageFormat: Format with which to encode the image (cv2 string).
-        '''
-        success, encodedImage = cv.imencode(imageFormat, image)
-        if not success: raise Exception("Failed to encode image")
-        self.__noLock_storeDataJsonPair(key, encodedImage.tobytes(), j)
+        with self.__lock.write: self.__noLock_storeStringJsonPair(key, s, j)
     
     def storeImageJsonPair(self, key, image, j, imageFormat = ".jpg"):
         '''
         Stores an image and a json in the dataset.
         Parameters:
-            key: The key to associate with the data (a string).
+            key: The key to associate with the data (a string, or a bytes object if already encoded as latin1).
             image: The image to store (a numpy/cv2 array).
             j: The json to store (a json - either a dictionary or an array).
             imageFormat: Format with which to encode the image (cv2 string).
         '''
-        with self.__lock: self.__noLock_storeImageJsonPair(key, image, j, imageFormat = imageFormat)
+        encodedImage = self.__encodeImage(image, imageFormat)
+        with self.__lock.write: self.__noLock_storeDataJsonPair(key, encodedImage, j)
     
     def __noLock_readData(self, key):
         '''
         Reads some data from the dataset.
         Parameters:
-            key: The key associated with the data to read (a string).
+            key: The key associated with the data to read (a string, or a bytes object if already encoded as latin1).
         Returns:
             A bytes object containing the read data.
         '''
-        if not type(key) is str: raise Exception("The provided key is not a string")
-        if self.__lmdbEnv is None: raise Exception("The LMDB environment has not been initialized")
-        with self.__lmdbEnv.begin(write = True) as transaction:
-            return transaction.get(key.encode('latin1'))
+        if __debug__:
+            if not type(key) in (str, bytes): raise Exception("The provided key is neither a string nor a bytes object")
+        return self.__noLock_readValue(key, bytes)
     
     def readData(self, key):
         '''
         Reads some data from the dataset.
         Parameters:
-            key: The key associated with the data to read (a string).
+            key: The key associated with the data to read (a string, or a bytes object if already encoded as latin1).
         Returns:
             A bytes object containing the read data.
         '''
-        with self.__lock: return self.__noLock_readData(key)
+        with self.__lock.read: return self.__noLock_readData(key)
+    
+    def __noLock_readMany(self, keys):
+        '''
+        Reads the data associated with many keys in a single transaction.
+        Parameters:
+            keys: The keys associated with the data to read (strings, or bytes objects if already encoded as latin1).
+        Returns:
+            A list containing, for each key, a bytes object with the read data (or None if the key was not found).
+        '''
+        if self.__lmdbEnv is None: raise Exception("The LMDB environment has not been initialized")
+        transaction = getattr(self.__batch, 'transaction', None)
+        if transaction is None: transaction = self.__noLock_readTransaction()
+        get = transaction.get
+        data = []
+        for key in keys:
+            if __debug__:
+                if not type(key) in (str, bytes): raise Exception("The provided key is neither a string nor a bytes object")
+            value = get(key if type(key) is bytes else key.encode('latin1'))
+            data.append(None if value is None else bytes(value))
+        return data
+    
+    def readMany(self, keys):
+        '''
+        Reads the data associated with many keys in a single transaction.
+        Parameters:
+            keys: The keys associated with the data to read (strings, or bytes objects if already encoded as latin1).
+        Returns:
+            A list containing, for each key, a bytes object with the read data (or None if the key was not found).
+        '''
+        with self.__lock.read: return self.__noLock_readMany(keys)
+    
+    def __noLock_readValue(self, key, decode):
+        '''
+        Reads a value from the dataset and decodes it before its transaction ends.
+        Parameters:
+            key: The key associated with the value to read (a string, or a bytes object if already encoded as latin1).
+            decode: A function decoding the value, which receives a memoryview of the memory map
+                (only valid until it returns) instead of a copy.
+        Returns:
+            The decoded value, or None if the key was not found.
+        '''
+        if __debug__:
+            if not type(key) in (str, bytes): raise Exception("The provided key is neither a string nor a bytes object")
+        if self.__lmdbEnv is None: raise Exception("The LMDB environment has not been initialized")
+        transaction = getattr(self.__batch, 'transaction', None)
+        if transaction is not None:
+            value = transaction.get(LmdbSingleFileDataset.__EncodeKey(key))
+            return None if value is None else decode(value)
+        value = self.__noLock_readTransaction().get(LmdbSingleFileDataset.__EncodeKey(key))
+        return None if value is None else decode(value)
+    
+    def __noLock_readTransaction(self):
+        '''
+        Returns the read transaction of the calling thread, which is reused across reads
+        and renewed after the dataset is written to or reopened.
+        '''
+        reader = self.__reader
+        transaction = getattr(reader, 'transaction', None)
+        if transaction is None or reader.generation != self.__generation:
+            if transaction is not None:
+                transaction.abort()
+                self.__readTransactions.discard(transaction)
+            reader.transaction = transaction = self.__lmdbEnv.begin(write = False, buffers = True)
+            reader.generation = self.__generation
+            self.__readTransactions.add(transaction)
+        return transaction
+    
+    def __noLock_releaseReadTransactions(self):
+        '''
+        Aborts the read transactions cached by all the threads (which must not be using them, i.e. the write lock must be held).
+        A read transaction pins the snapshot it was started on: while it is open, LMDB cannot reuse the pages freed
+        by later commits, so the file keeps growing (and LmdbDataset moves on to a new file early) even if no thread
+        reads again. Writes therefore release them before starting their transaction (and batches after committing),
+        and each thread starts a new one on its next read.
+        '''
+        for transaction in self.__readTransactions: transaction.abort()
+        self.__readTransactions.clear()
+        self.__generation += 1
+    
+    __FastPaths = ('readData', 'readString', 'readImage')
+    
+    def __noLock_installFastPaths(self):
+        '''
+        While the dataset is open, readData, readString and readImage are replaced by closures over
+        the open environment, which go straight to the transaction without the method indirections
+        and the environment checks of the generic path. They are removed when the dataset is closed.
+        '''
+        acquireRead, releaseRead = self.__lock.acquireRead, self.__lock.releaseRead
+        batch = self.__batch
+        readTransaction = self.__noLock_readTransaction
+        decodeImage = self.__decodeImage
+        
+        def get(key):
+            if __debug__:
+                if not type(key) in (str, bytes): raise Exception("The provided key is neither a string nor a bytes object")
+            transaction = getattr(batch, 'transaction', None)
+            if transaction is None: transaction = readTransaction()
+            return transaction.get(key if type(key) is bytes else key.encode('latin1'))
+        
+        def readData(key):
+            acquireRead()
+            try:
+                value = get(key)
+                return None if value is None else bytes(value)
+            finally:
+                releaseRead()
+        
+        def readString(key):
+            acquireRead()
+            try:
+                value = get(key)
+                return None if value is None else str(value, 'latin1')
+            finally:
+                releaseRead()
+        
+        def readImage(key):
+            acquireRead()
+            try:
+                value = get(key)
+                return None if value is None else decodeImage(value)
+            finally:
+                releaseRead()
+        
+        self.readData, self.readString, self.readImage = readData, readString, readImage
+    
+    def refreshReadTransaction(self):
+        '''
+        Ends the read transaction of the calling thread, so that the next read sees the latest
+        data (including writes made by other processes). The writes of this dataset already release the read
+        transactions of all threads, but a thread that stops reading while other processes write to the LMDB file
+        should call this, since its transaction keeps them from reusing the space freed by their commits.
+        '''
+        with self.__lock.read:
+            transaction = getattr(self.__reader, 'transaction', None)
+            if transaction is not None:
+                transaction.abort()
+                self.__readTransactions.discard(transaction)
+            self.__reader.transaction = None
     
     def __noLock_readString(self, key):
         '''
         Reads some data from the dataset.
         Parameters:
-            key: The key associated with the data to read (a string).
+            key: The key associated with the data to read (a string, or a bytes object if already encoded as latin1).
         Returns:
             A string containing the read data.
         '''
-        if not type(key) is str: raise Exception("The provided key is not a string")
+        if __debug__:
+            if not type(key) in (str, bytes): raise Exception("The provided key is neither a string nor a bytes object")
         data = self.__noLock_readData(key)
         if data is None: return None
         return data.decode('latin1')
@@ -246,97 +861,122 @@ class LmdbSingleFileDataset(object):
         '''
         Reads some data from the dataset.
         Parameters:
-            key: The key associated with the data to read (a string).
+            key: The key associated with the data to read (a string, or a bytes object if already encoded as latin1).
         Returns:
             A string containing the read data.
         '''
-        with self.__lock: return self.__noLock_readString(key)
+        with self.__lock.read: return self.__noLock_readString(key)
     
     def __noLock_readJson(self, key):
         '''
         Reads some data from the dataset.
         Parameters:
-            key: The key associated with the data to read (a string).
+            key: The key associated with the data to read (a string, or a bytes object if already encoded as latin1).
         Returns:
             A JSON containing the read data (either a dictionary or an array).
         '''
-        if not type(key) is str: raise Exception("The provided key is not a string")
-        jsonString = self.__noLock_readString(key)
-        if jsonString is None: return None
-        return json.loads(jsonString)
+        if __debug__:
+            if not type(key) in (str, bytes): raise Exception("The provided key is neither a string nor a bytes object")
+        return self.__noLock_readValue(key, LmdbSingleFileDataset.LoadJson)
     
     def readJson(self, key):
         '''
         Reads some data from the dataset.
         Parameters:
-            key: The key associated with the data to read (a string).
+            key: The key associated with the data to read (a string, or a bytes object if already encoded as latin1).
         Returns:
             A JSON containing the read data (either a dictionary or an array).
         '''
-        with self.__lock: return self.__noLock_readJson(key)
+        with self.__lock.read: return self.__noLock_readJson(key)
     
     def __noLock_readImage(self, key):
         '''
         Reads an image from the dataset.
         Parameters:
-            key: The key associated with the image to read (a string).
+            key: The key associated with the image to read (a string, or a bytes object if already encoded as latin1).
         Returns:
             The loaded image (a numpy/cv2 array).
         '''
-        encodedImage = self.__noLock_readData(key)
-        if encodedImage is None: return None
-        return cv.imdecode(np.frombuffer(encodedImage, np.uint8), -1)
+        return self.__noLock_readValue(key, self.__decodeImage)
     
     def readImage(self, key):
         '''
         Reads an image from the dataset.
         Parameters:
-            key: The key associated with the image to read (a string).
+            key: The key associated with the image to read (a string, or a bytes object if already encoded as latin1).
         Returns:
             The loaded image (a numpy/cv2 array).
         '''
-        with self.__lock: return self.__noLock_readImage(key)
+        with self.__lock.read: return self.__noLock_readImage(key)
     
     def __noLock_readDataJsonPair(self, key):
         '''
         Reads some data and a json from the dataset.
         Parameters:
-            key: The key associated with the data to read (a string).
+            key: The key associated with the data to read (a string, or a bytes object if already encoded as latin1).
         Returns:
             A tuple containing:
                 1. The read data (a bytes object).
                 2. The read json (either a dictionary or an array).
         '''
-        if not type(key) is str: raise Exception("The provided key is not a string")
-        dataJsonPair = self.__noLock_readJson(key)
+        if __debug__:
+            if not type(key) in (str, bytes): raise Exception("The provided key is neither a string nor a bytes object")
+        dataJsonPair = self.__noLock_readValue(key, LmdbSingleFileDataset.__DecodeDataJsonPairCopy)
         if dataJsonPair is None: return None, None
-        data = base64.decodebytes(dataJsonPair["d"].encode('ascii'))
-        j = dataJsonPair["j"]
-        return data, j
+        return dataJsonPair
     
     def readDataJsonPair(self, key):
         '''
         Reads some data and a json from the dataset.
         Parameters:
-            key: The key associated with the data to read (a string).
+            key: The key associated with the data to read (a string, or a bytes object if already encoded as latin1).
         Returns:
             A tuple containing:
                 1. The read data (a bytes object).
                 2. The read json (either a dictionary or an array).
         '''
-        with self.__lock: return self.__noLock_readDataJsonPair(key)
+        with self.__lock.read: return self.__noLock_readDataJsonPair(key)
+    
+    def __noLock_readArrayJsonPair(self, key):
+        '''
+        Reads a numpy array and a json from the dataset.
+        Parameters:
+            key: The key associated with the data to read (a string, or a bytes object if already encoded as latin1).
+        Returns:
+            A tuple containing:
+                1. The read array (a numpy array).
+                2. The read json (either a dictionary or an array).
+        '''
+        if __debug__:
+            if not type(key) in (str, bytes): raise Exception("The provided key is neither a string nor a bytes object")
+        arrayJsonPair = self.__noLock_readValue(key, LmdbSingleFileDataset.DecodeArrayJsonPair)
+        if arrayJsonPair is None: return None, None
+        return arrayJsonPair
+    
+    def readArrayJsonPair(self, key):
+        '''
+        Reads a numpy array and a json from the dataset.
+        Parameters:
+            key: The key associated with the data to read (a string, or a bytes object if already encoded as latin1).
+        Returns:
+            A tuple containing:
+                1. The read array (a numpy array).
+                2. The read json (either a dictionary or an array).
+        '''
+        with self.__lock.read: return self.__noLock_readArrayJsonPair(key)
     
     def __noLock_readStringJsonPair(self, key):
         '''
         Reads some string and a json from the dataset.
         Parameters:
-            key: The key associated with the data to read (a string).
+            key: The key associated with the data to read (a string, or a bytes object if already encoded as latin1).
         Returns:
             A tuple containing:
                 1. The read string (a string).
                 2. The read json (either a dictionary or an array).
         '''
-        if not type(key) is str: raise Exception("The provided key is not a string")
+        if __debug__:
+            if not type(key) in (str, bytes): raise Exception("The provided key is neither a string nor a bytes object")
         data, j = self.__noLock_readDataJsonPair(key)
         if data is None: return None, None
         return data.decode('latin1'), j
@@ -345,63 +985,92 @@ class LmdbSingleFileDataset(object):
         '''
         Reads some string and a json from the dataset.
         Parameters:
-            key: The key associated with the data to read (a string).
+            key: The key associated with the data to read (a string, or a bytes object if already encoded as latin1).
         Returns:
             A tuple containing:
                 1. The read string (a string).
                 2. The read json (either a dictionary or an array).
         '''
-        with self.__lock: return self.__noLock_readStringJsonPair(key)
+        with self.__lock.read: return self.__noLock_readStringJsonPair(key)
     
     def __noLock_readImageJsonPair(self, key):
         '''
         Reads an image and a json from the dataset.
         Parameters:
-            key: The key associated with the data to read (a string).
+            key: The key associated with the data to read (a string, or a bytes object if already encoded as latin1).
         Returns:
             A tuple containing:
                 1. The read image (a numpy/cv2 array).
                 2. The read json (either a dictionary or an array).
         '''
-        if not type(key) is str: raise Exception("The provided key is not a string")
-        encodedImage, j = self.__noLock_readDataJsonPair(key)
-        if encodedImage is None: return None, None
-        image = cv.imdecode(np.frombuffer(encodedImage, np.uint8), -1)
-        return image, j
+        if __debug__:
+            if not type(key) in (str, bytes): raise Exception("The provided key is neither a string nor a bytes object")
+        imageJsonPair = self.__noLock_readValue(key, self.__decodeImageJsonPair)
+        if imageJsonPair is None: return None, None
+        return imageJsonPair
     
     def readImageJsonPair(self, key):
         '''
         Reads an image and a json from the dataset.
         Parameters:
-            key: The key associated with the data to read (a string).
+            key: The key associated with the data to read (a string, or a bytes object if already encoded as latin1).
         Returns:
             A tuple containing:
                 1. The read image (a numpy/cv2 array).
                 2. The read json (either a dictionary or an array).
         '''
-        with self.__lock: return self.__noLock_readImageJsonPair(key)
+        with self.__lock.read: return self.__noLock_readImageJsonPair(key)
+    
+    def __noLock_readImageJsonRecord(self, key):
+        '''
+        Reads an image and a json from the dataset, without decoding the image until it is accessed.
+        Parameters:
+            key: The key associated with the data to read (a string, or a bytes object if already encoded as latin1).
+        Returns:
+            An ImageJsonRecord, or None if the key was not found.
+        '''
+        if __debug__:
+            if not type(key) in (str, bytes): raise Exception("The provided key is neither a string nor a bytes object")
+        return self.__noLock_readValue(key, self.__decodeImageJsonRecord)
+    
+    def readImageJsonRecord(self, key):
+        '''
+        Reads an image and a json from the dataset, without decoding the image until it is accessed.
+        Parameters:
+            key: The key associated with the data to read (a string, or a bytes object if already encoded as latin1).
+        Returns:
+            An ImageJsonRecord, or None if the key was not found.
+        '''
+        with self.__lock.read: return self.__noLock_readImageJsonRecord(key)
     
     def __noLock_delete(self, key):
         '''
         Deletes an entry from the dataset.
         Parameters:
-            key: The key associated with the entry to delete (a string).
+            key: The key associated with the entry to delete (a string, or a bytes object if already encoded as latin1).
         Returns:
             True if the entry was found (and deleted), otherwise False.
         '''
-        if not type(key) is str: raise Exception("The provided key is not a string")
+        if self.__readOnly: raise Exception("The LMDB dataset has been opened in read-only mode")
+        if __debug__:
+            if not type(key) in (str, bytes): raise Exception("The provided key is neither a string nor a bytes object")
+        if self.__lmdbEnv is None: raise Exception("The LMDB environment has not been initialized")
+        transaction = self.__noLock_batchTransaction()
+        if transaction is not None: return transaction.delete(LmdbSingleFileDataset.__EncodeKey(key))
+        self.__noLock_releaseReadTransactions()
         with self.__lmdbEnv.begin(write = True) as transaction:
-            return transaction.delete(key.encode('latin1'))
+            deleted = transaction.delete(LmdbSingleFileDataset.__EncodeKey(key))
+        return deleted
     
     def delete(self, key):
         '''
         Deletes an entry from the dataset.
         Parameters:
-            key: The key associated with the entry to delete (a string).
+            key: The key associated with the entry to delete (a string, or a bytes object if already encoded as latin1).
         Returns:
             True if the entry was found (and deleted), otherwise False.
         '''
-        with self.__lock: return self.__noLock_delete(key)
+        with self.__lock.write: return self.__noLock_delete(key)
 
 
 class LmdbDataset(object):
@@ -409,26 +1078,79 @@ class LmdbDataset(object):
     # Default map size (1024 MB)
     DefaultMapSize = 1024 * 1024 * 1024
     
-    def __init__(self, path, mapSize = None, readOnly = False):
-        self.__lock = threading.Lock()
+    # Record of the keys log: LMDB file index (-1 for deleted keys) and key length, followed by the latin1-encoded key.
+    # Key changes are appended to keys.log as they happen, and merged into keys.json when the dataset is closed.
+    KeysLogRecord = struct.Struct('<iH')
+    
+    LmdbDatasetNamePattern = re.compile(r'lmdb_dataset_(\d{12})')
+    
+    def __init__(self, path, mapSize = None, readOnly = False, writemap = False, noSync = False, noMetaSync = False, mapAsync = False, noReadAhead = False,
+                 jpegQuality = 95, colorspace = 'BGR', shardCount = 1, shardSelector = None,
+                 asyncWorkers = None, asyncFlushInterval = 0.05):
+        '''
+        Parameters:
+            path: The directory containing the LMDB files.
+            mapSize: The maximum size of each LMDB file.
+            readOnly, writemap, noSync, noMetaSync, mapAsync, noReadAhead, jpegQuality, colorspace: Passed to each LmdbSingleFileDataset.
+            shardCount: The number of LMDB files written to in parallel. With 1, entries are written to the last LMDB file,
+                moving on to a new one when it is full. With more, each entry is written to the LMDB file (shard) selected
+                by the hash of its key, so threads storing entries in different shards do not wait for each other;
+                shards do not move on to new LMDB files when full, so mapSize must be large enough, and batches are not supported.
+            shardSelector: A function returning the shard (an int from 0 to shardCount - 1) of the key it is passed, used instead
+                of the hash of the key (None to use the hash). Reads are routed with it instead of looking the key up in the keys
+                index, so it must always return the same shard for the same key, also across runs.
+            asyncWorkers: The number of threads encoding the images passed to storeImageAsync (None for the ThreadPoolExecutor default).
+            asyncFlushInterval: For how long (in seconds) storeImageAsync collects encoded images before writing them in a single transaction.
+        '''
+        if shardCount < 1: raise Exception("The shard count must be at least 1")
+        if shardSelector is not None and shardCount == 1: raise Exception("A shard selector requires more than one shard")
+        self.__lock = ReadWriteLock()
         self.__path = path
         self.__mapSize = LmdbDataset.DefaultMapSize if mapSize is None else mapSize
         self.__readOnly = readOnly
+        self.__datasetOptions = { "writemap": writemap, "noSync": noSync, "noMetaSync": noMetaSync, "mapAsync": mapAsync, "noReadAhead": noReadAhead,
+                                  "jpegQuality": jpegQuality, "colorspace": colorspace }
         self.__keys = None
+        self.__keysArray = None
+        self.__keysLog = None
+        self.__keysLogDirty = False
         self.__lmdbDatasets = None
         self.__lastLmdbDatasetIndex = None
+        self.__batch = threading.local()
+        self.__shardCount = shardCount
+        self.__shardSelector = shardSelector
+        # With more than one shard, stores only hold the read side of self.__lock, and use this lock
+        # to update the keys index (reserving the keys being stored, so they are not stored twice)
+        self.__keysLock = threading.Lock()
+        self.__reservedKeys = set()
+        self.__storeLock = self.__lock.write if shardCount == 1 else self.__lock.read
+        # storeImageAsync: a pool of threads encodes the images and a single writer thread stores them,
+        # so encoding overlaps with the LMDB commits. Both are started on the first call.
+        self.__asyncWorkers = asyncWorkers
+        self.__asyncFlushInterval = asyncFlushInterval
+        self.__asyncLock = threading.Lock()
+        self.__asyncEncoder = None
+        self.__asyncQueue = None
+        self.__asyncWriter = None
+        self.__asyncFutures = set()
     
     def __enter__(self):
-        with self.__lock:
+        with self.__lock.write:
             if not os.path.isdir(self.__path): os.mkdir(self.__path)
             self.__noLock_loadKeys()
             self.__noLock_openAll()
         return self
     
     def __exit__(self, exc_type, exc_value, exc_traceback):
-        with self.__lock:
+        self.__stopAsync()
+        with self.__lock.write:
+            if self.isBatching(): self.__noLock_endBatch(exc_type is None)
             self.__noLock_closeAll(exc_type, exc_value, exc_traceback)
-            if not self.__readOnly: self.__noLock_saveKeys()
+            if not self.__readOnly and (self.__keysLogDirty or not os.path.isfile(os.path.join(self.__path, "keys.json"))):
+                self.__noLock_saveKeys()
+            elif self.__keysLog is not None:
+                self.__keysLog.close()
+                self.__keysLog = None
     
     @staticmethod
     def __ComposeLmdbDatasetName(i):
@@ -436,31 +1158,28 @@ class LmdbDataset(object):
     
     @staticmethod
     def __IsValidLmdbDatasetName(n):
-        if not n.startswith("lmdb_dataset_"): return False
-        if len(n) != 25: return False
-        return True
+        return LmdbDataset.LmdbDatasetNamePattern.fullmatch(n) is not None
         
     @staticmethod
     def __ParseLmdbDatasetName(n):
-        if not LmdbDataset.__IsValidLmdbDatasetName(n): raise Exception("Bad LMDB Dataset name '{}'".format(n))
-        return int(n[13:])
+        match = LmdbDataset.LmdbDatasetNamePattern.fullmatch(n)
+        if match is None: raise Exception("Bad LMDB Dataset name '{}'".format(n))
+        return int(match.group(1))
     
     def __noLock_composeLmdbDatasetPath(self, i):
         return os.path.join(self.__path, LmdbDataset.__ComposeLmdbDatasetName(i))
     
     def __composeLmdbDatasetPath(self, i):
-        with self.__lock: return self.__noLock_composeLmdbDatasetPath(i)
+        with self.__lock.read: return self.__noLock_composeLmdbDatasetPath(i)
     
     def __noLock_findLmdbDatasets(self):
-        lmdbDatasets = []
-        for f in os.listdir(self.__path):
-            if LmdbDataset.__IsValidLmdbDatasetName(f):
-                lmdbDatasets.append(LmdbDataset.__ParseLmdbDatasetName(f))
-        lmdbDatasets.sort()
-        return lmdbDatasets
+        fullmatch = LmdbDataset.LmdbDatasetNamePattern.fullmatch
+        with os.scandir(self.__path) as entries:
+            matches = [ fullmatch(entry.name) for entry in entries ]
+        return sorted(int(match.group(1)) for match in matches if match is not None)
     
     def __findLmdbDatasets(self):
-        with self.__lock: self.__noLock_findLmdbDatasets()
+        with self.__lock.read: self.__noLock_findLmdbDatasets()
     
     def __noLock_lastLmdbDataset(self):
         if self.__lmdbDatasets is None: raise Exception("The LMDB Database has not been opened")
@@ -471,7 +1190,7 @@ class LmdbDataset(object):
             return self.__lastLmdbDatasetIndex, self.__lmdbDatasets[self.__lastLmdbDatasetIndex]
     
     def __lastLmdbDataset(self):
-        with self.__lock: return self.__noLock_lastLmdbDataset()
+        with self.__lock.write: return self.__noLock_lastLmdbDataset()
     
     def __noLock_nextLmdbDatsetIndex(self):
         lastIdx, _ = self.__noLock_lastLmdbDataset()
@@ -479,7 +1198,7 @@ class LmdbDataset(object):
         return lastIdx + 1
     
     def __nextLmdbDatasetIndex(self):
-        with self.__lock: return self.__noLock_nextLmdbDatsetIndex()
+        with self.__lock.write: return self.__noLock_nextLmdbDatsetIndex()
     
     def __noLock_loadKeys(self):
         keysFilePath = os.path.join(self.__path, "keys.json")
@@ -488,65 +1207,138 @@ class LmdbDataset(object):
                 self.__keys = json.load(f)
         else:
             self.__keys = {}
+        self.__keysLogDirty = False
+        keysLogPath = os.path.join(self.__path, "keys.log")
+        if os.path.isfile(keysLogPath):
+            with open(keysLogPath, 'rb') as f: self.__noLock_replayKeysLog(f.read())
+        self.__keysArray = None
+    
+    def __noLock_replayKeysLog(self, log):
+        record = LmdbDataset.KeysLogRecord
+        offset = 0
+        while offset + record.size <= len(log):
+            index, length = record.unpack_from(log, offset)
+            offset += record.size
+            # A truncated last record was being appended when the process died
+            if offset + length > len(log): break
+            key = log[offset:offset + length].decode('latin1')
+            offset += length
+            if index < 0: self.__keys.pop(key, None)
+            else: self.__keys[key] = index
+            self.__keysLogDirty = True
+    
+    def __noLock_logKeys(self, keys, index):
+        '''
+        Appends key changes to the keys log, with a single write per LMDB commit (batches log all their keys
+        when they are committed). It is called right after the commit, so a crash in between can only lose
+        the changes of that commit from the keys index: recalculateKeys() rebuilds it from the LMDB files.
+        Parameters:
+            keys: The changed keys (an iterable of strings).
+            index: The index of the LMDB file containing the keys, or -1 if they were deleted.
+        '''
+        if self.__keysLog is None: self.__keysLog = open(os.path.join(self.__path, "keys.log"), 'ab')
+        record = LmdbDataset.KeysLogRecord
+        encodedKeys = [ key.encode('latin1') for key in keys ]
+        self.__keysLog.write(b''.join(record.pack(index, len(k)) + k for k in encodedKeys))
+        self.__keysLog.flush()
+        self.__keysLogDirty = True
         
     def __loadKeys(self):
-        with self.__lock: self.__noLock_loadKeys()
+        with self.__lock.write: self.__noLock_loadKeys()
     
     def __noLock_saveKeys(self):
         if self.__readOnly: raise Exception("The LMDB dataset has been opened in read-only mode")
         keysFilePath = os.path.join(self.__path, "keys.json")
-        with open(keysFilePath, 'w') as f: json.dump(self.__keys, f)
+        with open(keysFilePath + ".tmp", 'w') as f: json.dump(self.__keys, f)
+        os.replace(keysFilePath + ".tmp", keysFilePath)
+        if self.__keysLog is not None:
+            self.__keysLog.close()
+            self.__keysLog = None
+        keysLogPath = os.path.join(self.__path, "keys.log")
+        if os.path.isfile(keysLogPath): os.remove(keysLogPath)
+        self.__keysLogDirty = False
         
     def __saveKeys(self):
-        with self.__lock: self.__noLock_saveKeys()
+        with self.__lock.write: self.__noLock_saveKeys()
     
     def __noLock_recalculateKeys(self):
         keys = {}
-        for i, d in self.__lmdbDatasets.items():
-            for k in d.keys():
-                keys[k] = i
+        for i, d in self.__lmdbDatasets.items(): keys.update(dict.fromkeys(d.iterKeys(), i))
         self.__keys = keys
+        self.__keysArray = None
         self.__noLock_saveKeys()
     
     def recalculateKeys(self):
-        with self.__lock: self.__noLock_recalculateKeys()
+        with self.__lock.write: self.__noLock_recalculateKeys()
     
     def __noLock_keys(self, recalculate = False):
         if recalculate: self.__noLock_recalculateKeys()
-        return list(self.__keys.keys())
+        with self.__keysLock:
+            return self.__noLock_keysArray().tolist()
+    
+    def __noLock_keysArray(self):
+        # Cached as a numpy object array, so that it can be copied and permuted at C speed
+        if self.__keysArray is None: self.__keysArray = np.array(list(self.__keys.keys()), dtype = object)
+        return self.__keysArray
     
     def keys(self, recalculate = False):
-        with self.__lock: return self.__noLock_keys(recalculate)
+        with (self.__lock.write if recalculate else self.__lock.read): return self.__noLock_keys(recalculate)
     
-    def iterateKeys(self, random = True, forever = True):
-        keys = self.keys()
+    def refreshReadTransactions(self):
+        '''
+        Ends the read transactions of the calling thread, so that the next reads see the latest data.
+        '''
+        with self.__lock.read:
+            if self.__lmdbDatasets is None: raise Exception("The LMDB Dataset has not been opened")
+            for d in self.__lmdbDatasets.values(): d.refreshReadTransaction()
+    
+    def iterateKeys(self, shuffle = True, forever = True):
+        '''
+        Iterates over the keys of the dataset (as they are when the iteration starts).
+        Parameters:
+            shuffle: Whether to iterate in a new random order at every epoch.
+            forever: Whether to start over when all the keys have been iterated over.
+        '''
+        with self.__lock.read:
+            with self.__keysLock: keys = self.__noLock_keysArray()
         while True:
-            if random: random.shuffle(keys)
-            for k in keys: yield k
+            self.refreshReadTransactions()
+            if shuffle:
+                for i in np.random.permutation(len(keys)): yield keys[i]
+            else:
+                yield from keys
             if not forever: break
     
     def __noLock_getDatasetContaining(self, key):
+        '''
+        Returns the LmdbSingleFileDataset containing the key, or None if the key is not in the dataset
+        (with a shard selector, the shard the key would be stored in, without checking the keys index).
+        '''
+        if self.__lmdbDatasets is None: raise Exception("The LMDB Dataset has not been opened")
+        if self.__shardSelector is not None: return self.__lmdbDatasets.get(self.__shardSelector(key))
         i = self.__keys.get(key)
-        if i is None: return None
-        return i, self.__lmdbDatasets[i]
+        return None if i is None else self.__lmdbDatasets[i]
         
     def __noLock_open(self, i):
         lmdbDatasetPath = self.__noLock_composeLmdbDatasetPath(i)
-        lmdbDataset = LmdbSingleFileDataset(lmdbDatasetPath, mapSize = self.__mapSize, readOnly = self.__readOnly)
+        lmdbDataset = LmdbSingleFileDataset(lmdbDatasetPath, mapSize = self.__mapSize, readOnly = self.__readOnly, **self.__datasetOptions)
         lmdbDataset.__enter__()
         return lmdbDataset
     
     def __open(self, i):
-        with self.__lock: return self.__noLock_open(i)
+        with self.__lock.write: return self.__noLock_open(i)
     
     def __noLock_openAll(self):
         self.__noLock_closeAll()
         self.__lmdbDatasets = { i: self.__noLock_open(i) for i in self.__noLock_findLmdbDatasets() }
+        if not self.__readOnly:
+            for i in range(self.__shardCount):
+                if i not in self.__lmdbDatasets: self.__lmdbDatasets[i] = self.__noLock_open(i)
         if len(self.__lmdbDatasets) > 0: self.__lastLmdbDatasetIndex = max(self.__lmdbDatasets.keys())
         else: self.__lastLmdbDatasetIndex = None
     
     def __openAll(self):
-        with self.__lock: self.__noLock_openAll()
+        with self.__lock.write: self.__noLock_openAll()
     
     def __noLock_openNext(self):
         nextIdx = self.__noLock_nextLmdbDatsetIndex()
@@ -556,18 +1348,23 @@ class LmdbDataset(object):
         return nextIdx, lmdbDataset
     
     def __openNext(self):
-        with self.__lock: return self.__noLock_openNext()
+        with self.__lock.write: return self.__noLock_openNext()
     
     def __noLock_closeAll(self, exc_type = None, exc_value = None, exc_traceback = None):
         if not self.__lmdbDatasets is None:
-            for _, d in self.__lmdbDatasets.items():
-                d.__exit__(exc_type, exc_value, exc_traceback)
-                del d
+            datasets = list(self.__lmdbDatasets.values())
+            self.__lmdbDatasets.clear()
+            if len(datasets) == 1:
+                datasets[0].__exit__(exc_type, exc_value, exc_traceback)
+            elif len(datasets) > 1:
+                # Closing an LMDB file (sync and unmap) is independent of the others, so they are closed in parallel
+                with concurrent.futures.ThreadPoolExecutor(max_workers = min(32, len(datasets))) as executor:
+                    for future in [ executor.submit(d.__exit__, exc_type, exc_value, exc_traceback) for d in datasets ]: future.result()
             self.__lmdbDatasets = None
             self.__lastLmdbDatasetIndex = None
     
     def __closeAll(self, exc_type = None, exc_value = None, exc_traceback = None):
-        with self.__lock: self.__noLock_closeAll(exc_type, exc_value, exc_traceback)
+        with self.__lock.write: self.__noLock_closeAll(exc_type, exc_value, exc_traceback)
     
     def __noLock_getHeadDataset(self):
         if self.__lmdbDatasets is None: raise Exception("The LMDB Dataset has not been opened")
@@ -578,7 +1375,189 @@ class LmdbDataset(object):
         return d
     
     def __getHeadDataset(self):
-        with self.__lock: return self.__noLock_getHeadDataset()
+        with self.__lock.write: return self.__noLock_getHeadDataset()
+    
+    def __noLock_store(self, keys, store, size = 0):
+        '''
+        Stores entries in the head LMDB file, moving on to a new LMDB file when the head one is full.
+        Parameters:
+            keys: The keys of the entries being stored (a tuple of strings).
+            store: A function storing the entries in the LmdbSingleFileDataset it is passed.
+            size: The size of the stored data in bytes (counted towards the maxBytes limit of a batch).
+        '''
+        if self.__shardCount > 1: return self.__noLock_storeInShard(keys, store)
+        if not self.__keys.keys().isdisjoint(keys): raise Exception("Key already exists")
+        self.__keysArray = None
+        pending = getattr(self.__batch, 'pending', None)
+        try:
+            store(self.__noLock_getHeadDataset())
+        except lmdb.MapFullError:
+            self.__noLock_rollOver(pending, keys, store)
+        else:
+            if pending is not None: pending.append((keys, store))
+            else: self.__noLock_logKeys(keys, self.__lastLmdbDatasetIndex)
+            self.__keys.update(dict.fromkeys(keys, self.__lastLmdbDatasetIndex))
+        if pending is not None: self.__noLock_growBatch(len(keys), size)
+    
+    def __noLock_growBatch(self, items, size):
+        '''
+        Accounts for entries stored in the batch of the calling thread, committing it
+        and starting a new one when it reaches its maxItems or maxBytes limit.
+        '''
+        batch = self.__batch
+        batch.items += items
+        batch.bytes += size
+        if (batch.maxItems is not None and batch.items >= batch.maxItems) or (batch.maxBytes is not None and batch.bytes >= batch.maxBytes):
+            maxItems, maxBytes = batch.maxItems, batch.maxBytes
+            self.__noLock_endBatch(True)
+            self.__noLock_beginBatch(maxItems, maxBytes)
+    
+    def __noLock_shardOf(self, key):
+        if self.__shardSelector is not None: return self.__shardSelector(key)
+        return zlib.crc32(key.encode('latin1')) % self.__shardCount
+    
+    def __noLock_storeInShard(self, keys, store):
+        '''
+        Stores entries in the shard selected by the hash of their keys (which must all belong to the same shard).
+        Only the read side of self.__lock is held, so the keys index is updated under self.__keysLock.
+        '''
+        if self.__lmdbDatasets is None: raise Exception("The LMDB Dataset has not been opened")
+        index = self.__noLock_shardOf(keys[0])
+        if not 0 <= index < self.__shardCount: raise Exception("The shard selector returned an invalid shard")
+        with self.__keysLock:
+            if not self.__keys.keys().isdisjoint(keys) or not self.__reservedKeys.isdisjoint(keys): raise Exception("Key already exists")
+            self.__reservedKeys.update(keys)
+        try:
+            store(self.__lmdbDatasets[index])
+            with self.__keysLock:
+                self.__noLock_logKeys(keys, index)
+                self.__keys.update(dict.fromkeys(keys, index))
+                self.__keysArray = None
+        finally:
+            with self.__keysLock: self.__reservedKeys.difference_update(keys)
+    
+    def __noLock_rollOver(self, pending, keys, store):
+        '''
+        Opens the next LMDB file after the head one is full, and stores the entries there.
+        If a batch is in progress, it is moved to the new LMDB file, since the failed write
+        transaction of the full one has to be discarded.
+        '''
+        if pending is None:
+            _, d = self.__noLock_openNext()
+            store(d)
+            self.__noLock_logKeys(keys, self.__lastLmdbDatasetIndex)
+            self.__keys.update(dict.fromkeys(keys, self.__lastLmdbDatasetIndex))
+            return
+        self.__noLock_getHeadDataset().abortBatch()
+        _, d = self.__noLock_openNext()
+        d.beginBatch()
+        pending.append((keys, store))
+        try:
+            for _, pendingStore in pending: pendingStore(d)
+        except lmdb.MapFullError:
+            d.abortBatch()
+            self.__batch.pending = None
+            for pendingKeys, _ in pending:
+                for key in pendingKeys: self.__keys.pop(key, None)
+            raise Exception("The batch does not fit in a single LMDB file")
+        for pendingKeys, _ in pending:
+            self.__keys.update(dict.fromkeys(pendingKeys, self.__lastLmdbDatasetIndex))
+    
+    def __noLock_beginBatch(self, maxItems = None, maxBytes = None):
+        if self.__readOnly: raise Exception("The LMDB dataset has been opened in read-only mode")
+        if self.__shardCount > 1: raise Exception("Batches are not supported with more than one shard")
+        if getattr(self.__batch, 'pending', None) is not None: raise Exception("A batch is already in progress")
+        self.__noLock_getHeadDataset().beginBatch()
+        self.__batch.pending = []
+        self.__batch.maxItems = maxItems
+        self.__batch.maxBytes = maxBytes
+        self.__batch.items = 0
+        self.__batch.bytes = 0
+    
+    def beginBatch(self, maxItems = None, maxBytes = None):
+        '''
+        Starts a batch: every following store on the calling thread is written in a single
+        LMDB transaction, until commitBatch() or abortBatch() is called.
+        The stored entries are kept in memory until the batch ends, in case it has to be moved to a new LMDB file.
+        Parameters:
+            maxItems: If not None, the batch is committed (and a new one started) every time this many entries have been stored.
+            maxBytes: If not None, the batch is committed (and a new one started) every time this much data (in bytes) has been stored.
+                Only the stored data is counted, not the jsons nor the LMDB overhead.
+        '''
+        with self.__lock.write: self.__noLock_beginBatch(maxItems, maxBytes)
+    
+    def __noLock_endBatch(self, commit):
+        pending = getattr(self.__batch, 'pending', None)
+        if pending is None: raise Exception("No batch is in progress")
+        self.__batch.pending = None
+        head = self.__noLock_getHeadDataset()
+        if commit:
+            head.commitBatch()
+            self.__noLock_logKeys([ key for keys, _ in pending for key in keys ], self.__lastLmdbDatasetIndex)
+        else:
+            head.abortBatch()
+            self.__keysArray = None
+            for keys, _ in pending:
+                for key in keys: self.__keys.pop(key, None)
+    
+    def commitBatch(self):
+        '''
+        Commits the batch started by the calling thread.
+        '''
+        with self.__lock.write: self.__noLock_endBatch(True)
+    
+    def abortBatch(self):
+        '''
+        Discards everything stored in the batch started by the calling thread.
+        '''
+        with self.__lock.write: self.__noLock_endBatch(False)
+    
+    def isBatching(self):
+        '''
+        Returns True if the calling thread has a batch in progress.
+        '''
+        return getattr(self.__batch, 'pending', None) is not None
+    
+    @contextlib.contextmanager
+    def batch(self, maxItems = None, maxBytes = None):
+        '''
+        Context manager wrapping beginBatch() and commitBatch() (or abortBatch() on errors).
+        With maxItems or maxBytes, the batch is committed in chunks (see beginBatch()),
+        so an error only discards the entries stored since the last chunk was committed.
+        '''
+        self.beginBatch(maxItems, maxBytes)
+        try:
+            yield self
+        except:
+            if self.isBatching(): self.abortBatch()
+            raise
+        self.commitBatch()
+    
+    def __noLock_storeMany(self, items):
+        '''
+        Stores many entries in the dataset with a single cursor.putmulti() call.
+        Parameters:
+            items: The (key, data) pairs to store (strings and bytes objects).
+        '''
+        items = list(items)
+        keys = tuple(key for key, _ in items)
+        if len(set(keys)) != len(keys): raise Exception("Duplicate keys provided")
+        if self.__shardCount == 1:
+            self.__noLock_store(keys, lambda d: d.storeMany(items), sum(len(data) for _, data in items))
+            return
+        shards = {}
+        for item in items: shards.setdefault(self.__noLock_shardOf(item[0]), []).append(item)
+        for shardItems in shards.values():
+            self.__noLock_store(tuple(key for key, _ in shardItems), lambda d, shardItems = shardItems: d.storeMany(shardItems))
+    
+    def storeMany(self, items):
+        '''
+        Stores many entries in the dataset with a single cursor.putmulti() call
+        (one per shard with more than one shard, each shard being stored atomically on its own).
+        Parameters:
+            items: The (key, data) pairs to store (strings and bytes objects).
+        '''
+        with self.__storeLock: self.__noLock_storeMany(items)
     
     def __noLock_storeData(self, key, data):
         '''
@@ -587,13 +1566,7 @@ class LmdbDataset(object):
             key: The key to associate with the data (a string).
             data: The data to store (a bytes object).
         '''
-        try:
-            if key in self.__keys: raise Exception("Key already exists")
-            self.__noLock_getHeadDataset().storeData(key, data)
-        except lmdb.MapFullError:
-            _, d = self.__noLock_openNext()
-            d.storeData(key, data)
-        self.__keys[key] = self.__lastLmdbDatasetIndex
+        self.__noLock_store((key,), lambda d: d.storeData(key, data), len(data))
     
     def storeData(self, key, data):
         '''
@@ -602,7 +1575,7 @@ class LmdbDataset(object):
             key: The key to associate with the data (a string).
             data: The data to store (a bytes object).
         '''
-        with self.__lock: self.__noLock_storeData(key, data)
+        with self.__storeLock: self.__noLock_storeData(key, data)
     
     def __noLock_storeString(self, key, s):
         '''
@@ -611,13 +1584,7 @@ class LmdbDataset(object):
             key: The key to associate with the data (a string).
             s: The data to store (a string).
         '''
-        try:
-            if key in self.__keys: raise Exception("Key already exists")
-            self.__noLock_getHeadDataset().storeString(key, s)
-        except lmdb.MapFullError:
-            _, d = self.__noLock_openNext()
-            d.storeString(key, s)
-        self.__keys[key] = self.__lastLmdbDatasetIndex
+        self.__noLock_store((key,), lambda d: d.storeString(key, s), len(s))
     
     def storeString(self, key, s):
         '''
@@ -626,7 +1593,7 @@ class LmdbDataset(object):
             key: The key to associate with the data (a string).
             s: The data to store (a string).
         '''
-        with self.__lock: self.__noLock_storeString(key, s)
+        with self.__storeLock: self.__noLock_storeString(key, s)
     
     def __noLock_storeJson(self, key, j):
         '''
@@ -635,13 +1602,7 @@ class LmdbDataset(object):
             key: The key to associate with the data (a string).
             j: The data to store (a json - either a dictionary or an array).
         '''
-        try:
-            if key in self.__keys: raise Exception("Key already exists")
-            self.__noLock_getHeadDataset().storeJson(key, j)
-        except lmdb.MapFullError:
-            _, d = self.__noLock_openNext()
-            d.storeJson(key, j)
-        self.__keys[key] = self.__lastLmdbDatasetIndex
+        self.__noLock_store((key,), lambda d: d.storeJson(key, j))
     
     def storeJson(self, key, j):
         '''
@@ -650,9 +1611,9 @@ class LmdbDataset(object):
             key: The key to associate with the data (a string).
             j: The data to store (a json - either a dictionary or an array).
         '''
-        with self.__lock: self.__noLock_storeJson(key, j)
+        with self.__storeLock: self.__noLock_storeJson(key, j)
     
-    def __noLock_storeImage(self, key, image, imageFormat = ".jpg"):
+    def storeImage(self, key, image, imageFormat = ".jpg"):
         '''
         Stores an image in the dataset.
         Parameters:
@@ -660,23 +1621,106 @@ class LmdbDataset(object):
             image: The image to store (as a numpy/cv2 array).
             imageFormat: Format with which to encode the image (cv2 string).
         '''
-        try:
-            if key in self.__keys: raise Exception("Key already exists")
-            self.__noLock_getHeadDataset().storeImage(key, image)
-        except lmdb.MapFullError:
-            _, d = self.__noLock_openNext()
-            d.storeImage(key, image)
-        self.__keys[key] = self.__lastLmdbDatasetIndex
+        encodedImage = self.__encodeImage(image, imageFormat)
+        with self.__storeLock: self.__noLock_storeData(key, encodedImage)
     
-    def storeImage(self, key, image, imageFormat = ".jpg"):
+    def __encodeImage(self, image, imageFormat):
+        return LmdbSingleFileDataset.EncodeImage(image, imageFormat, self.__datasetOptions["jpegQuality"], self.__datasetOptions["colorspace"])
+    
+    def storeImageAsync(self, key, image, imageFormat = ".jpg"):
         '''
-        Stores an image in the dataset.
+        Stores an image in the dataset in the background: the image is encoded by a pool of threads,
+        and the encoded images are written by a single thread, many at a time (see asyncFlushInterval).
+        The image must not be modified until the returned future is done. Call flush() to wait for all stores.
         Parameters:
             key: The key to associate with the data (a string).
             image: The image to store (as a numpy/cv2 array).
             imageFormat: Format with which to encode the image (cv2 string).
+        Returns:
+            A concurrent.futures.Future, done when the image has been stored (or has failed to be).
+        '''
+        if self.__readOnly: raise Exception("The LMDB dataset has been opened in read-only mode")
+        future = concurrent.futures.Future()
+        with self.__asyncLock:
+            if self.__asyncEncoder is None:
+                self.__asyncEncoder = concurrent.futures.ThreadPoolExecutor(max_workers = self.__asyncWorkers)
+                self.__asyncQueue = queue.Queue()
+                self.__asyncWriter = threading.Thread(target = self.__asyncWrite, daemon = True)
+                self.__asyncWriter.start()
+            self.__asyncFutures.add(future)
+            self.__asyncEncoder.submit(self.__asyncEncode, key, image, imageFormat, future)
+        future.add_done_callback(self.__asyncDone)
+        return future
+    
+    def __asyncDone(self, future):
+        with self.__asyncLock: self.__asyncFutures.discard(future)
+    
+    def __asyncEncode(self, key, image, imageFormat, future):
+        try:
+            self.__asyncQueue.put((key, self.__encodeImage(image, imageFormat), future))
+        except Exception as e:
+            future.set_exception(e)
+    
+    def __asyncWrite(self):
+        stopping = False
+        while not stopping:
+            item = self.__asyncQueue.get()
+            if item is None: break
+            items = [ item ]
+            deadline = time.monotonic() + self.__asyncFlushInterval
+            while True:
+                try:
+                    item = self.__asyncQueue.get(timeout = max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                items.append(item)
+            if self.__shardCount == 1:
+                self.__asyncWriteMany(items)
+                continue
+            # Each shard is committed on its own, so they are stored separately: when one fails,
+            # the images already committed to the others must not be stored again
+            shards = {}
+            for item in items: shards.setdefault(self.__noLock_shardOf(item[0]), []).append(item)
+            for shardItems in shards.values(): self.__asyncWriteMany(shardItems)
+    
+    def __asyncWriteMany(self, items):
+        '''
+        Stores (key, encoded image, future) items with a single storeMany (atomic, so either all or none of them are stored),
+        falling back to storing them one by one if it fails, so that each future gets its own outcome.
         '''
-        with self.__lock: self.__noLock_storeImage(key, image, imageFormat = imageFormat)
+        try:
+            with self.__storeLock: self.__noLock_storeMany((key, data) for key, data, _ in items)
+        except Exception:
+            for key, data, future in items:
+                try:
+                    with self.__storeLock: self.__noLock_storeData(key, data)
+                except Exception as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(None)
+        else:
+            for _, _, future in items: future.set_result(None)
+    
+    def flush(self):
+        '''
+        Waits for all the stores started by storeImageAsync to be done.
+        '''
+        with self.__asyncLock: futures = list(self.__asyncFutures)
+        concurrent.futures.wait(futures)
+    
+    def __stopAsync(self):
+        with self.__asyncLock:
+            encoder, writer = self.__asyncEncoder, self.__asyncWriter
+            self.__asyncEncoder = None
+            self.__asyncWriter = None
+        if encoder is None: return
+        encoder.shutdown(wait = True)
+        self.__asyncQueue.put(None)
+        writer.join()
+        self.__asyncQueue = None
     
     def __noLock_storeDataJsonPair(self, key, data, j):
         '''
@@ -686,13 +1730,7 @@ class LmdbDataset(object):
             data: The data to store (a bytes object).
             j: The json to store (a json - either a dictionary or an array).
         '''
-        try:
-            if key in self.__keys: raise Exception("Key already exists")
-            self.__noLock_getHeadDataset().storeDataJsonPair(key, data, j)
-        except lmdb.MapFullError:
-            _, d = self.__noLock_openNext()
-            d.storeDataJsonPair(key, data, j)
-        self.__keys[key] = self.__lastLmdbDatasetIndex
+        self.__noLock_store((key,), lambda d: d.storeDataJsonPair(key, data, j), len(data))
     
     def storeDataJsonPair(self, key, data, j):
         '''
@@ -702,50 +1740,38 @@ class LmdbDataset(object):
             data: The data to store (a bytes object).
             j: The json to store (a json - either a dictionary or an array).
         '''
-        with self.__lock: self.__noLock_storeDataJsonPair(key, data, j)
+        with self.__storeLock: self.__noLock_storeDataJsonPair(key, data, j)
     
-    def __noLock_storeStringJsonPair(self, key, s, j):
+    def storeArrayJsonPair(self, key, array, j):
         '''
-        Stores some data and a json in the dataset.
+        Stores a numpy array and a json in the dataset (see LmdbSingleFileDataset.EncodeArrayJsonPair).
         Parameters:
             key: The key to associate with the data (a string).
-            s: The string to store (a string).
+            array: The array to store (a numpy array).
             j: The json to store (a json - either a dictionary or an array).
         '''
-        try:
-            if key in self.__keys: raise Exception("Key already exists")
-            self.__noLock_getHeadDataset().storeStringJsonPair(key, s, j)
-        except lmdb.MapFullError:
-            _, d = self.__noLock_openNext()
-            d.storeStringJsonPair(key, s, j)
-        self.__keys[key] = self.__lastLmdbDatasetIndex
+        value = LmdbSingleFileDataset.EncodeArrayJsonPair(array, j)
+        with self.__storeLock: self.__noLock_storeData(key, value)
     
-    def storeStringJsonPair(self, key, s, j):
+    def __noLock_storeStringJsonPair(self, key, s, j):
         '''
         Stores some data and a json in the dataset.
         Parameters:
             key: The key to associate with the data (a string).
-            data: The string to store (a string).
+            s: The string to store (a string).
             j: The json to store (a json - either a dictionary or an array).
         '''
-        with self.__lock: self.__noLock_storeStringJsonPair(key, s, j)
+        self.__noLock_store((key,), lambda d: d.storeStringJsonPair(key, s, j), len(s))
     
-    def __noLock_storeImageJsonPair(self, key, image, j, imageFormat = ".jpg"):
+    def storeStringJsonPair(self, key, s, j):
         '''
-        Stores an image and a json in the dataset.
+        Stores some data and a json in the dataset.
         Parameters:
             key: The key to associate with the data (a string).
-            image: The image to store (a numpy/cv2 array).
+            data: The string to store (a string).
             j: The json to store (a json - either a dictionary or an array).
-            imageFormat: Format with which to encode the image (cv2 string).
         '''
-        try:
-            if key in self.__keys: raise Exception("Key already exists")
-            self.__noLock_getHeadDataset().storeImageJsonPair(key, image, j)
-        except lmdb.MapFullError:
-            _, d = self.__noLock_openNext()
-            d.storeImageJsonPair(key, image, j)
-        self.__keys[key] = self.__lastLmdbDatasetIndex
+        with self.__storeLock: self.__noLock_storeStringJsonPair(key, s, j)
     
     def storeImageJsonPair(self, key, image, j, imageFormat = ".jpg"):
         '''
@@ -756,7 +1782,8 @@ class LmdbDataset(object):
             j: The json to store (a json - either a dictionary or an array).
             imageFormat: Format with which to encode the image (cv2 string).
         '''
-        with self.__lock: self.__noLock_storeImageJsonPair(key, image, j, imageFormat = imageFormat)
+        encodedImage = self.__encodeImage(image, imageFormat)
+        with self.__storeLock: self.__noLock_storeDataJsonPair(key, encodedImage, j)
     
     def __noLock_readData(self, key):
         '''
@@ -766,10 +1793,8 @@ class LmdbDataset(object):
         Returns:
             A bytes object containing the read data.
         '''
-        if self.__lmdbDatasets is None: raise Exception("The LMDB Dataset has not been opened")
-        _, d = self.__noLock_getDatasetContaining(key)
-        if d is None: return None
-        return d.readData(key)
+        d = self.__noLock_getDatasetContaining(key)
+        return None if d is None else d.readData(key)
     
     def readData(self, key):
         '''
@@ -779,7 +1804,39 @@ class LmdbDataset(object):
         Returns:
             A bytes object containing the read data.
         '''
-        with self.__lock: return self.__noLock_readData(key)
+        with self.__lock.read: return self.__noLock_readData(key)
+    
+    def __noLock_readMany(self, keys):
+        '''
+        Reads the data associated with many keys, with a single transaction per LMDB file.
+        Parameters:
+            keys: The keys associated with the data to read (strings).
+        Returns:
+            A list containing, for each key, a bytes object with the read data (or None if the key was not found).
+        '''
+        if self.__lmdbDatasets is None: raise Exception("The LMDB Dataset has not been opened")
+        keys = list(keys)
+        positionsByDataset = {}
+        indexOf = self.__keys.get if self.__shardSelector is None else self.__shardSelector
+        for position, key in enumerate(keys):
+            i = indexOf(key)
+            if i is not None: positionsByDataset.setdefault(i, []).append(position)
+        data = [ None ] * len(keys)
+        for i, positions in positionsByDataset.items():
+            d = self.__lmdbDatasets.get(i)
+            if d is None: continue
+            for position, value in zip(positions, d.readMany([ keys[p] for p in positions ])): data[position] = value
+        return data
+    
+    def readMany(self, keys):
+        '''
+        Reads the data associated with many keys, with a single transaction per LMDB file.
+        Parameters:
+            keys: The keys associated with the data to read (strings).
+        Returns:
+            A list containing, for each key, a bytes object with the read data (or None if the key was not found).
+        '''
+        with self.__lock.read: return self.__noLock_readMany(keys)
     
     def __noLock_readString(self, key):
         '''
@@ -789,10 +1846,8 @@ class LmdbDataset(object):
         Returns:
             A string containing the read data.
         '''
-        if self.__lmdbDatasets is None: raise Exception("The LMDB Dataset has not been opened")
-        _, d = self.__noLock_getDatasetContaining(key)
-        if d is None: return None
-        return d.readString(key)
+        d = self.__noLock_getDatasetContaining(key)
+        return None if d is None else d.readString(key)
     
     def readString(self, key):
         '''
@@ -802,7 +1857,7 @@ class LmdbDataset(object):
         Returns:
             A string containing the read data.
         '''
-        with self.__lock: return self.__noLock_readString(key)
+        with self.__lock.read: return self.__noLock_readString(key)
     
     def __noLock_readJson(self, key):
         '''
@@ -812,10 +1867,8 @@ class LmdbDataset(object):
         Returns:
             A JSON containing the read data (either a dictionary or an array).
         '''
-        if self.__lmdbDatasets is None: raise Exception("The LMDB Dataset has not been opened")
-        _, d = self.__noLock_getDatasetContaining(key)
-        if d is None: return None
-        return d.readJson(key)
+        d = self.__noLock_getDatasetContaining(key)
+        return None if d is None else d.readJson(key)
     
     def readJson(self, key):
         '''
@@ -825,7 +1878,7 @@ class LmdbDataset(object):
         Returns:
             A JSON containing the read data (either a dictionary or an array).
         '''
-        with self.__lock: return self.__noLock_readJson(key)
+        with self.__lock.read: return self.__noLock_readJson(key)
     
     def __noLock_readImage(self, key):
         '''
@@ -835,10 +1888,8 @@ class LmdbDataset(object):
         Returns:
             The loaded image (a numpy/cv2 array).
         '''
-        if self.__lmdbDatasets is None: raise Exception("The LMDB Dataset has not been opened")
-        _, d = self.__noLock_getDatasetContaining(key)
-        if d is None: return None
-        return d.readImage(key)
+        d = self.__noLock_getDatasetContaining(key)
+        return None if d is None else d.readImage(key)
     
     def readImage(self, key):
         '''
@@ -848,7 +1899,7 @@ class LmdbDataset(object):
         Returns:
             The loaded image (a numpy/cv2 array).
         '''
-        with self.__lock: return self.__noLock_readImage(key)
+        with self.__lock.read: return self.__noLock_readImage(key)
     
     def __noLock_readDataJsonPair(self, key):
         '''
@@ -860,10 +1911,8 @@ class LmdbDataset(object):
                 1. The read data (a bytes object).
                 2. The read json (either a dictionary or an array).
         '''
-        if self.__lmdbDatasets is None: raise Exception("The LMDB Dataset has not been opened")
-        _, d = self.__noLock_getDatasetContaining(key)
-        if d is None: return None, None
-        return d.readDataJsonPair(key)
+        d = self.__noLock_getDatasetContaining(key)
+        return (None, None) if d is None else d.readDataJsonPair(key)
     
     def readDataJsonPair(self, key):
         '''
@@ -875,7 +1924,32 @@ class LmdbDataset(object):
                 1. The read data (a bytes object).
                 2. The read json (either a dictionary or an array).
         '''
-        with self.__lock: return self.__noLock_readDataJsonPair(key)
+        with self.__lock.read: return self.__noLock_readDataJsonPair(key)
+    
+    def __noLock_readArrayJsonPair(self, key):
+        '''
+        Reads a numpy array and a json from the dataset.
+        Parameters:
+            key: The key associated with the data to read (a string).
+        Returns:
+            A tuple containing:
+                1. The read array (a numpy array).
+                2. The read json (either a dictionary or an array).
+        '''
+        d = self.__noLock_getDatasetContaining(key)
+        return (None, None) if d is None else d.readArrayJsonPair(key)
+    
+    def readArrayJsonPair(self, key):
+        '''
+        Reads a numpy array and a json from the dataset.
+        Parameters:
+            key: The key associated with the data to read (a string).
+        Returns:
+            A tuple containing:
+                1. The read array (a numpy array).
+                2. The read json (either a dictionary or an array).
+        '''
+        with self.__lock.read: return self.__noLock_readArrayJsonPair(key)
     
     def __noLock_readStringJsonPair(self, key):
         '''
@@ -887,10 +1961,8 @@ class LmdbDataset(object):
                 1. The read string (a string).
                 2. The read json (either a dictionary or an array).
         '''
-        if self.__lmdbDatasets is None: raise Exception("The LMDB Dataset has not been opened")
-        _, d = self.__noLock_getDatasetContaining(key)
-        if d is None: return None, None
-        return d.readStringJsonPair(key)
+        d = self.__noLock_getDatasetContaining(key)
+        return (None, None) if d is None else d.readStringJsonPair(key)
     
     def readStringJsonPair(self, key):
         '''
@@ -902,7 +1974,7 @@ class LmdbDataset(object):
                 1. The read string (a string).
                 2. The read json (either a dictionary or an array).
         '''
-        with self.__lock: return self.__noLock_readStringJsonPair(key)
+        with self.__lock.read: return self.__noLock_readStringJsonPair(key)
     
     def __noLock_readImageJsonPair(self, key):
         '''
@@ -914,10 +1986,8 @@ class LmdbDataset(object):
                 1. The read image (a numpy/cv2 array).
                 2. The read json (either a dictionary or an array).
         '''
-        if self.__lmdbDatasets is None: raise Exception("The LMDB Dataset has not been opened")
-        _, d = self.__noLock_getDatasetContaining(key)
-        if d is None: return None, None
-        return d.readImageJsonPair(key)
+        d = self.__noLock_getDatasetContaining(key)
+        return (None, None) if d is None else d.readImageJsonPair(key)
     
     def readImageJsonPair(self, key):
         '''
@@ -929,7 +1999,28 @@ class LmdbDataset(object):
                 1. The read image (a numpy/cv2 array).
                 2. The read json (either a dictionary or an array).
         '''
-        with self.__lock: return self.__noLock_readImageJsonPair(key)
+        with self.__lock.read: return self.__noLock_readImageJsonPair(key)
+    
+    def __noLock_readImageJsonRecord(self, key):
+        '''
+        Reads an image and a json from the dataset, without decoding the image until it is accessed.
+        Parameters:
+            key: The key associated with the data to read (a string).
+        Returns:
+            An ImageJsonRecord, or None if the key was not found.
+        '''
+        d = self.__noLock_getDatasetContaining(key)
+        return None if d is None else d.readImageJsonRecord(key)
+    
+    def readImageJsonRecord(self, key):
+        '''
+        Reads an image and a json from the dataset, without decoding the image until it is accessed.
+        Parameters:
+            key: The key associated with the data to read (a string).
+        Returns:
+            An ImageJsonRecord, or None if the key was not found.
+        '''
+        with self.__lock.read: return self.__noLock_readImageJsonRecord(key)
     
     def __noLock_delete(self, key):
         '''
@@ -939,19 +2030,28 @@ class LmdbDataset(object):
         Returns:
             True if the entry was found (and deleted), otherwise False.
         '''
-        if self.__lmdbDatasets is None: raise Exception("The LMDB Dataset has not been opened")
-        _, d = self.__noLock_getDatasetContaining(key)
+        d = self.__noLock_getDatasetContaining(key)
         if d is None: return False
-        if not d.delete(key): return False
+        if self.isBatching():
+            maxItems, maxBytes = self.__batch.maxItems, self.__batch.maxBytes
+            self.__noLock_endBatch(True)
+            try:
+                if not d.delete(key): return False
+            finally:
+                self.__noLock_beginBatch(maxItems, maxBytes)
+        elif not d.delete(key): return False
+        self.__noLock_logKeys((key,), -1)
         self.__keys.pop(key, None)
+        self.__keysArray = None
         return True
     
     def delete(self, key):
         '''
         Deletes an entry from the dataset.
+        If a batch is in progress, it is committed before the entry is deleted.
         Parameters:
             key: The key associated with the entry to delete (a string).
         Returns:
             True if the entry was found (and deleted), otherwise False.
         '''
-        with self.__lock: return self.__noLock_delete(key)
+        with self.__lock.write: return self.__noLock_delete(key)
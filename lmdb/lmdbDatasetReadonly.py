@@ -1,17 +1,33 @@
 import os
-import json
 import lmdb
-import random
-import base64
+import itertools
 import threading
-import cv2 as cv
-import numpy as np
 from pathlib import Path
 from lmdbDataset import LmdbSingleFileDataset, LmdbDataset
 
+def scan_lmdb_datasets_paths(path):
+    '''
+    Finds the LMDB files (lmdb_dataset_000000000000, lmdb_dataset_000000000001, ...) in a directory with a single scan.
+    Parameters:
+        path: The directory containing the LMDB files (a Path).
+    Returns:
+        The paths of the LMDB files, in order, up to the first missing one.
+    '''
+    indices = {}
+    fullmatch = LmdbDataset.LmdbDatasetNamePattern.fullmatch
+    with os.scandir(path) as entries:
+        for entry in entries:
+            match = fullmatch(entry.name)
+            if match is not None and entry.is_dir():
+                indices[int(match.group(1))] = entry.name
+    lmdb_paths = []
+    while len(lmdb_paths) in indices:
+        lmdb_paths.append(path.joinpath(indices[len(lmdb_paths)]))
+    return lmdb_paths
+
 class LmdbSingleFileDatasetReadonly:
 
-    def __init__(self, path, map_size=LmdbSingleFileDataset.DefaultMapSize, open_on_init=True, percentage=100):
+    def __init__(self, path, map_size=LmdbSingleFileDataset.DefaultMapSize, open_on_init=True, percentage=100, readahead=False):
         self.percentage = percentage
         path_obj = Path(path)
         if not path_obj.is_dir():
@@ -19,8 +35,16 @@ class LmdbSingleFileDatasetReadonly:
         self.path = str(path_obj.absolute())
         del path_obj
         self.map_size = map_size
+        # Readahead is off by default (MDB_NORDAHEAD, i.e. madvise(MADV_RANDOM) on the memory map), since training
+        # reads records in random order and readahead would just fill the page cache with unneeded pages
+        self.readahead = readahead
         self.__keys = None
+        # Set of the keys, only when restricted to a percentage of the dataset (otherwise LMDB tells which keys exist)
+        self.__keys_set = None
         self.__lmdb_env = None
+        # Each thread reuses a read transaction, renewed when the dataset is reopened or the process is forked
+        self.__reader = threading.local()
+        self.__generation = 0
         if open_on_init:
             self.open()
     
@@ -30,17 +54,22 @@ class LmdbSingleFileDatasetReadonly:
     def open(self):
         if self.is_open():
             raise Exception('Dataset is already open')
-        self.__lmdb_env = lmdb.open(self.path, map_size=self.map_size, readonly=True, lock=False)
-        with self.__lmdb_env.begin() as transaction:
-            self.__keys = [ key.decode('latin1') for key, _ in transaction.cursor() ]
+        self.__lmdb_env = lmdb.open(self.path, map_size=self.map_size, readonly=True, lock=False, readahead=self.readahead)
+        self.__generation += 1
+        with self.__lmdb_env.begin(buffers=True) as transaction:
+            keys = transaction.cursor().iternext(keys=True, values=False)
             if self.percentage != 100:
-                self.__keys = self.__keys[:round(len(self.__keys)*self.percentage/100)]
+                keys = itertools.islice(keys, round(transaction.stat()['entries']*self.percentage/100))
+            self.__keys = [ str(key, 'latin1') for key in keys ]
+        if self.percentage != 100:
+            self.__keys_set = frozenset(self.__keys)
     
     def close(self):
         if self.is_open():
             self.__lmdb_env.close()
             self.__lmdb_env = None
             self.__keys = None
+            self.__keys_set = None
 
     def is_open(self):
         return self.__lmdb_env is not None
@@ -48,19 +77,73 @@ class LmdbSingleFileDatasetReadonly:
     def keys(self):
         return self.__keys
 
-    def read_data(self, key):
+    def __read_transaction(self):
+        reader = self.__reader
+        transaction = getattr(reader, 'transaction', None)
+        if transaction is None or reader.generation != self.__generation or reader.pid != os.getpid():
+            transaction = reader.transaction = self.__lmdb_env.begin(buffers=True)
+            reader.generation = self.__generation
+            reader.pid = os.getpid()
+        return transaction
+
+    def renew(self):
+        '''
+        Ends the read transaction of the calling thread, so that the next read starts a new one
+        (and sees the latest data, if the LMDB file has been written to since).
+        '''
+        transaction = getattr(self.__reader, 'transaction', None)
+        if transaction is not None and self.__reader.generation == self.__generation:
+            transaction.abort()
+        self.__reader.transaction = None
+
+    def read_data(self, key, copy=True):
         '''
         Reads some data from the dataset.
         Parameters:
             key: The key associated with the data to read (a string).
+            copy: Whether to copy the data out of the memory map. If False, a memoryview of the memory map is returned
+                without copying the data; it is only valid until renew() or close() is called (and only on the calling thread).
+        Returns:
+            A bytes object (or a memoryview, if copy is False) containing the read data.
+        '''
+        return self.__read_value(key, bytes if copy else LmdbSingleFileDatasetReadonly.__view)
+
+    @staticmethod
+    def __view(value):
+        return value
+    
+    def __read_value(self, key, decode):
+        '''
+        Reads a value from the dataset and decodes it before its transaction ends.
+        Parameters:
+            key: The key associated with the value to read (a string).
+            decode: A function decoding the value, which receives a memoryview of the memory map instead of a copy.
+        Returns:
+            The decoded value, or None if the key was not found.
+        '''
+        if __debug__:
+            if not type(key) is str: raise Exception("The provided key is not a string")
+        if self.__lmdb_env is None: raise Exception("The LMDB environment has not been initialized")
+        if self.__keys_set is not None and key not in self.__keys_set: return None
+        value = self.__read_transaction().get(key.encode('latin1'))
+        return None if value is None else decode(value)
+    
+    def read_many(self, keys, copy=True):
+        '''
+        Reads the data associated with many keys in a single transaction.
+        Parameters:
+            keys: The keys associated with the data to read (strings).
+            copy: Whether to copy the data out of the memory map (see read_data).
         Returns:
-            A bytes object containing the read data.
+            A list containing, for each key, a bytes object (or a memoryview, if copy is False) with the read data
+            (or None if the key was not found).
         '''
-        if not type(key) is str: raise Exception("The provided key is not a string")
         if self.__lmdb_env is None: raise Exception("The LMDB environment has not been initialized")
-        if key not in self.__keys: return None
-        with self.__lmdb_env.begin() as transaction:
-            return transaction.get(key.encode('latin1'))
+        get = self.__read_transaction().get
+        keys_set = self.__keys_set
+        values = [ get(key.encode('latin1')) if keys_set is None or key in keys_set else None for key in keys ]
+        if not copy: return values
+        return [ None if value is None else bytes(value) for value in values ]
     
     def read_string(self, key):
         '''
@@ -70,9 +153,11 @@ class LmdbSingleFileDatasetReadonly:
         Returns:
             A string containing the read data.
         '''
-        data = self.read_data(key)
-        if data is None: return None
-        return data.decode('latin1')
+        return self.__read_value(key, LmdbSingleFileDatasetReadonly.__decode_string)
+
+    @staticmethod
+    def __decode_string(value):
+        return str(value, 'latin1')
     
     def read_json(self, key):
         '''
@@ -82,9 +167,7 @@ class LmdbSingleFileDatasetReadonly:
         Returns:
             A JSON containing the read data (either a dictionary or an array).
         '''
-        json_string = self.read_string(key)
-        if json_string is None: return None
-        return json.loads(json_string)
+        return self.__read_value(key, LmdbSingleFileDataset.LoadJson)
     
     def read_data_json_pair(self, key):
         '''
@@ -96,31 +179,39 @@ class LmdbSingleFileDatasetReadonly:
                 1. The read data (a bytes object).
                 2. The read json (either a dictionary or an array).
         '''
-        data_json_pair = self.read_json(key)
+        data_json_pair = self.__read_value(key, LmdbSingleFileDatasetReadonly.__decode_data_json_pair)
         if data_json_pair is None: return None, None
-        data = base64.decodebytes(data_json_pair["d"].encode('ascii'))
-        j = data_json_pair["j"]
-        return data, j
+        return data_json_pair
+    
+    @staticmethod
+    def __decode_data_json_pair(value):
+        data, j = LmdbSingleFileDataset.DecodeDataJsonPair(value)
+        return bytes(data), j
     
-    def read_image_json_pair(self, key):
+    def read_image_json_pair(self, key, reduce=1):
         '''
         Reads an image and a json from the dataset.
         Parameters:
             key: The key associated with the data to read (a string).
+            reduce: 1 to read the image at full size, or 2, 4 or 8 to read it at 1/reduce of its size (see LmdbSingleFileDataset.DecodeImage).
         Returns:
             A tuple containing:
                 1. The read image (a numpy/cv2 array).
                 2. The read json (either a dictionary or an array).
         '''
-        encoded_image, j = self.read_data_json_pair(key)
-        if encoded_image is None: return None, None
-        image = cv.imdecode(np.frombuffer(encoded_image, np.uint8), -1)
-        return image, j
+        def decode_image_json_pair(value):
+            # The image is decoded straight from the memory map, without copying the encoded image
+            encoded_image, j = LmdbSingleFileDataset.DecodeDataJsonPair(value)
+            return LmdbSingleFileDataset.DecodeImage(encoded_image, reduce=reduce), j
+        image_json_pair = self.__read_value(key, decode_image_json_pair)
+        if image_json_pair is None: return None, None
+        return image_json_pair
 
 class LmdbDatasetReadonly:
     
-    def __init__(self, path, map_size=LmdbDataset.DefaultMapSize, open_on_init=True):
+    def __init__(self, path, map_size=LmdbDataset.DefaultMapSize, open_on_init=True, readahead=False):
         self.map_size = map_size
+        self.readahead = readahead
         self.path_obj = Path(path)
         if not self.path_obj.is_dir():
             raise Exception(f'Specified path {path} is not a directory')
@@ -138,15 +229,16 @@ class LmdbDatasetReadonly:
         paths = self.find_lmdb_datasets_paths()
         lmdb_datasets = []
         for p in paths:
-            lmdb_datasets.append(LmdbSingleFileDatasetReadonly(str(p.absolute()), map_size=self.map_size))
+            lmdb_datasets.append(LmdbSingleFileDatasetReadonly(str(p.absolute()), map_size=self.map_size, readahead=self.readahead))
         keys_dict = {}
         for i, d in enumerate(lmdb_datasets):
-            for k in d.keys():
-                keys_dict[k] = i
+            keys_dict.update(dict.fromkeys(d.keys(), i))
         self.__lmdb_datasets = lmdb_datasets
         self.__keys_dict = keys_dict
     
     def close(self):
+        if not self.is_open():
+            return
         for d in self.__lmdb_datasets:
             d.close()
         self.__lmdb_datasets = None
@@ -156,13 +248,7 @@ class LmdbDatasetReadonly:
         return self.__lmdb_datasets is not None
     
     def find_lmdb_datasets_paths(self):
-        lmdb_paths = []
-        for i in range(1000000000000):
-            name = "lmdb_dataset_{:012d}".format(i)
-            path = self.path_obj.joinpath(name)
-            if not path.exists() or not path.is_dir():
-                break
-            lmdb_paths.append(path)
+        lmdb_paths = scan_lmdb_datasets_paths(self.path_obj)
         if not lmdb_paths:
             raise Exception('No LMDB dataset folders found in specified path')
         return lmdb_paths
@@ -175,6 +261,27 @@ class LmdbDatasetReadonly:
     def keys(self):
         return self.__keys_dict.keys()
     
+    def read_many(self, keys, copy=True):
+        '''
+        Reads the data associated with many keys, with a single transaction per LMDB file.
+        Parameters:
+            keys: The keys associated with the data to read (strings).
+            copy: Whether to copy the data out of the memory map (see LmdbSingleFileDatasetReadonly.read_data).
+        Returns:
+            A list containing, for each key, a bytes object (or a memoryview, if copy is False) with the read data
+            (or None if the key was not found).
+        '''
+        keys = list(keys)
+        positions_by_dataset = {}
+        for position, key in enumerate(keys):
+            i = self.__keys_dict.get(key)
+            if i is not None: positions_by_dataset.setdefault(i, []).append(position)
+        data = [None] * len(keys)
+        for i, positions in positions_by_dataset.items():
+            for position, d in zip(positions, self.__lmdb_datasets[i].read_many([keys[p] for p in positions], copy=copy)):
+                data[position] = d
+        return data
+    
     def read_json(self, key):
         '''
         Reads some data from the dataset as a JSON object (either a dictionary or an array).
@@ -187,11 +294,12 @@ class LmdbDatasetReadonly:
         if d is None: return None, None
         return d.read_json(key)
     
-    def read_image_json_pair(self, key):
+    def read_image_json_pair(self, key, reduce=1):
         '''
         Reads an image and a json from the dataset.
         Parameters:
             key: The key associated with the data to read (a string).
+            reduce: 1 to read the image at full size, or 2, 4 or 8 to read it at 1/reduce of its size (see LmdbSingleFileDataset.DecodeImage).
         Returns:
             A tuple containing:
                 1. The read image (a numpy/cv2 array).
@@ -199,19 +307,19 @@ class LmdbDatasetReadonly:
         '''
         d = self.get_dataset_containing(key)
         if d is None: return None, None
-        return d.read_image_json_pair(key)
+        return d.read_image_json_pair(key, reduce=reduce)
 
 class LmdbMultipleDatasetsReadonly:
     
-    def __init__(self, paths, map_size=LmdbDataset.DefaultMapSize, open_on_init=True, percentage=100):
+    def __init__(self, paths, map_size=LmdbDataset.DefaultMapSize, open_on_init=True, percentage=100, readahead=False):
         self.percentage = percentage
         self.map_size = map_size
+        self.readahead = readahead
         self.path_objs = [Path(p) for p in paths]
         for p in self.path_objs:
             if not p.is_dir():
                 raise Exception(f'Specified path {p} is not a directory')
         self.__lmdb_datasets = None
-        self.__keys = None
         if open_on_init:
             self.open()
     
@@ -224,19 +332,15 @@ class LmdbMultipleDatasetsReadonly:
         paths = self.find_lmdb_datasets_paths()
         lmdb_datasets = []
         for p in paths:
-            lmdb_datasets.append(LmdbSingleFileDatasetReadonly(str(p.absolute()), map_size=self.map_size, percentage=self.percentage))
-        keys = []
-        for i, d in enumerate(lmdb_datasets):
-            for k in d.keys():
-                keys.append((i, k))
+            lmdb_datasets.append(LmdbSingleFileDatasetReadonly(str(p.absolute()), map_size=self.map_size, percentage=self.percentage, readahead=self.readahead))
         self.__lmdb_datasets = lmdb_datasets
-        self.__keys = keys
     
     def close(self):
+        if not self.is_open():
+            return
         for d in self.__lmdb_datasets:
             d.close()
         self.__lmdb_datasets = None
-        self.__keys = None
     
     def is_open(self):
         return self.__lmdb_datasets is not None
@@ -244,12 +348,7 @@ class LmdbMultipleDatasetsReadonly:
     def find_lmdb_datasets_paths(self):
         lmdb_paths = []
         for p in self.path_objs:
-            for i in range(1000000000000):
-                name = "lmdb_dataset_{:012d}".format(i)
-                path = p.joinpath(name)
-                if not path.exists() or not path.is_dir():
-                    break
-                lmdb_paths.append(path)
+            lmdb_paths.extend(scan_lmdb_datasets_paths(p))
         if not lmdb_paths:
             raise Exception('No LMDB dataset folders found in specified paths')
         return lmdb_paths
@@ -261,7 +360,30 @@ class LmdbMultipleDatasetsReadonly:
         return self.__lmdb_datasets[i]
     
     def keys(self):
-        return self.__keys
+        # A new list of (dataset index, key) tuples, built from the keys lists of the LMDB files: it is not
+        # kept by this object, since its only user (LmdbLoader) keeps its own copy for the whole training
+        return list(itertools.chain.from_iterable(zip(itertools.repeat(i), d.keys()) for i, d in enumerate(self.__lmdb_datasets)))
+    
+    def read_many(self, keys, copy=True):
+        '''
+        Reads the data associated with many keys, with a single transaction per LMDB file.
+        Parameters:
+            keys: The keys associated with the data to read ((dataset index, string) tuples, as returned by keys()).
+            copy: Whether to copy the data out of the memory map (see LmdbSingleFileDatasetReadonly.read_data).
+        Returns:
+            A list containing, for each key, a bytes object (or a memoryview, if copy is False) with the read data
+            (or None if the key was not found).
+        '''
+        keys = list(keys)
+        positions_by_dataset = {}
+        for position, key in enumerate(keys):
+            i = key[0] if key[0] < len(self.__lmdb_datasets) else None
+            if i is not None: positions_by_dataset.setdefault(i, []).append(position)
+        data = [None] * len(keys)
+        for i, positions in positions_by_dataset.items():
+            for position, d in zip(positions, self.__lmdb_datasets[i].read_many([keys[p][1] for p in positions], copy=copy)):
+                data[position] = d
+        return data
     
     def read_json(self, key):
         '''
@@ -275,11 +397,12 @@ class LmdbMultipleDatasetsReadonly:
         if d is None: return None, None
         return d.read_json(key[1])
     
-    def read_image_json_pair(self, key):
+    def read_image_json_pair(self, key, reduce=1):
         '''
         Reads an image and a json from the dataset.
         Parameters:
             key: The key associated with the data to read (a string).
+            reduce: 1 to read the image at full size, or 2, 4 or 8 to read it at 1/reduce of its size (see LmdbSingleFileDataset.DecodeImage).
         Returns:
             A tuple containing:
                 1. The read image (a numpy/cv2 array).
@@ -287,4 +410,4 @@ class LmdbMultipleDatasetsReadonly:
         '''
         d = self.get_dataset_containing(key)
         if d is None: return None, None
-        return d.read_image_json_pair(key[1])
\ No newline at end of file
+        return d.read_image_json_pair(key[1], reduce=reduce)
\ No newline at end of file
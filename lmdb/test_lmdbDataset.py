@@ -0,0 +1,99 @@
+import os
+import base64
+import shutil
+import pytest
+import numpy as np
+import lmdbDataset
+from lmdbDataset import LmdbSingleFileDataset, LmdbDataset
+
+MAP_SIZE = 1 << 20
+
+
+def lmdb_files(path):
+    return sorted(f for f in os.listdir(path) if LmdbDataset.LmdbDatasetNamePattern.fullmatch(f))
+
+
+def test_legacy_base64_data_json_pair(tmp_path):
+    # Values written by older versions: base64 data inside a json
+    data = bytes(range(256)) * 4
+    with LmdbDataset(str(tmp_path), mapSize=MAP_SIZE) as dataset:
+        dataset.storeJson('old', {'d': base64.encodebytes(data).decode('ascii'), 'j': {'boxes': [[0.1, 0.2, 0.3, 0.4, 1]]}})
+        dataset.storeDataJsonPair('new', data, {'boxes': []})
+        assert dataset.readDataJsonPair('old') == (data, {'boxes': [[0.1, 0.2, 0.3, 0.4, 1]]})
+        assert dataset.readDataJsonPair('new') == (data, {'boxes': []})
+
+
+def test_keys_log_replay_after_unclean_close(tmp_path):
+    path, copy = tmp_path / 'dataset', tmp_path / 'crashed'
+    dataset = LmdbDataset(str(path), mapSize=MAP_SIZE).__enter__()
+    dataset.storeData('a', b'1')
+    dataset.storeData('b', b'2')
+    dataset.delete('a')
+    with dataset.batch():
+        dataset.storeData('c', b'3')
+    # The state a crash would leave: no keys.json, and a keys.log with a torn last record
+    shutil.copytree(path, copy)
+    dataset.__exit__(None, None, None)
+    assert not (copy / 'keys.json').exists()
+    with open(copy / 'keys.log', 'ab') as f:
+        f.write(LmdbDataset.KeysLogRecord.pack(0, 10) + b'd')
+    with LmdbDataset(str(copy), mapSize=MAP_SIZE) as dataset:
+        assert sorted(dataset.keys()) == ['b', 'c']
+        assert dataset.readData('c') == b'3'
+    assert (copy / 'keys.json').exists() and not (copy / 'keys.log').exists()
+
+
+def test_batch_rolls_over_to_new_files(tmp_path):
+    data = os.urandom(100 * 1024)
+    with LmdbDataset(str(tmp_path), mapSize=MAP_SIZE) as dataset:
+        with dataset.batch(maxItems=4):
+            for i in range(30):
+                dataset.storeData(f'k{i}', data)
+    assert len(lmdb_files(tmp_path)) > 1
+    with LmdbDataset(str(tmp_path), mapSize=MAP_SIZE, readOnly=True) as dataset:
+        assert sorted(dataset.keys()) == sorted(f'k{i}' for i in range(30))
+        assert all(dataset.readData(f'k{i}') == data for i in range(30))
+
+
+def test_store_many_rejects_duplicate_keys(tmp_path):
+    with LmdbSingleFileDataset(str(tmp_path / 'single'), mapSize=MAP_SIZE) as dataset:
+        assert dataset.storeMany([('a', b'1'), ('b', b'2')]) == 2
+        with pytest.raises(Exception, match='Key already exists'):
+            dataset.storeMany([('c', b'3'), ('a', b'4')])
+        with pytest.raises(Exception, match='Key already exists'):
+            dataset.storeMany([('d', b'5'), ('d', b'6')])
+        assert dataset.readData('a') == b'1'
+        assert dataset.readData('c') is None and dataset.readData('d') is None
+    with LmdbDataset(str(tmp_path / 'multiple'), mapSize=MAP_SIZE) as dataset:
+        dataset.storeMany([('a', b'1')])
+        with pytest.raises(Exception):
+            dataset.storeMany([('c', b'3'), ('a', b'4')])
+        assert dataset.keys() == ['a'] and dataset.readData('c') is None
+
+
+def test_async_stores_with_a_failing_shard(tmp_path):
+    image = np.zeros((8, 8, 3), dtype=np.uint8)
+    # k0-k5 go to the first shard, which is committed before the second one fails on k11
+    shard_selector = lambda key: int(int(key[1:]) >= 6)
+    with LmdbDataset(str(tmp_path), mapSize=MAP_SIZE, shardCount=2, shardSelector=shard_selector, asyncFlushInterval=0.5) as dataset:
+        dataset.storeImage('k11', image)
+        futures = [dataset.storeImageAsync(f'k{i}', image) for i in range(12)]
+        dataset.flush()
+        assert all(f.exception() is None for f in futures[:11])
+        assert 'Key already exists' in str(futures[11].exception())
+        assert sorted(dataset.keys()) == sorted(f'k{i}' for i in range(12))
+
+
+@pytest.mark.parametrize('use_orjson', [True, False])
+def test_json_round_trip(tmp_path, monkeypatch, use_orjson):
+    if not use_orjson:
+        monkeypatch.setattr(lmdbDataset, 'orjson', None)
+    j = {'text': 'caf\u00e9 \u20ac', 'nan': float('nan'), 'array': np.arange(3), 'scalar': np.float32(0.5)}
+    with LmdbSingleFileDataset(str(tmp_path), mapSize=MAP_SIZE) as dataset:
+        dataset.storeJson('json', j)
+        # Stored as ASCII, like json.dumps, so that it can also be read as a string
+        assert dataset.readString('json') == '{"text":"caf\\u00e9 \\u20ac","nan":null,"array":[0,1,2],"scalar":0.5}'
+        assert dataset.readJson('json') == {'text': 'caf\u00e9 \u20ac', 'nan': None, 'array': [0, 1, 2], 'scalar': 0.5}
+        # Jsons stored as latin1 strings
+        dataset.storeString('string', '{"text":"caf\u00e9"}')
+        assert dataset.readJson('string') == {'text': 'caf\u00e9'}
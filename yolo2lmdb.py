@@ -1,8 +1,11 @@
 import argparse
 import os
 import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import yaml
+import numpy as np
 from tqdm import tqdm
 
 from utils.dataloaders import IMG_FORMATS
@@ -10,20 +13,56 @@ from utils.dataloaders import IMG_FORMATS
 sys.path.append(str(Path(__file__).parent.joinpath('lmdb')))
 from lmdbDataset import *
 
+IMG_FORMATS_SET = frozenset(f.lower() for f in IMG_FORMATS)
+
 def replace_last_occurrences(s, old, new, count=1):
     li = s.rsplit(old, count)
     return new.join(li)
 
-def img2label(path):
-    path_str = path.absolute().as_posix()
-    suffix = path.suffix
-    if suffix:
-        path_str = replace_last_occurrences(path_str, suffix, '.txt')
-    if path_str.endswith('/images'):
-        return replace_last_occurrences(path_str, 'images', 'labels')
+def imgs_dir2labels_dir(path):
+    # The labels of the images in .../images/... are in .../labels/..., so the
+    # directory is computed once per set instead of once per image
+    path_str = path.absolute().as_posix() + '/'
     if '/images/' not in path_str:
         raise ValueError
-    return Path(replace_last_occurrences(path_str, '/images/', '/labels/'))
+    return replace_last_occurrences(path_str, '/images/', '/labels/')
+
+def img2label(img_path, labels_dir):
+    return Path(labels_dir + img_path.name.rpartition('.')[0] + '.txt')
+
+def parse_labels(label_path):
+    # Returns the boxes (x, y, w, h as floats and the class as an int) and the classes as a numpy array
+    # Read as raw bytes: labels are ASCII, so there is no need to decode them before numpy parses them
+    with open(label_path, 'rb') as fl:
+        raw = fl.read()
+    if not raw.strip():
+        return [], np.empty(0, dtype=np.int64)
+    labels = np.loadtxt(raw.splitlines(), ndmin=2)
+    if labels.shape[1] != 5:
+        raise ValueError(f'expected 5 values per line, found {labels.shape[1]}')
+    if not np.isfinite(labels[:, 0]).all():
+        raise ValueError('could not parse class as integer')
+    cls = labels[:, 0].astype(np.int64)
+    xc, yc, w, h = labels[:, 1], labels[:, 2], labels[:, 3], labels[:, 4]
+    x = np.clip(xc - w / 2, 0, 1)
+    y = np.clip(yc - h / 2, 0, 1)
+    boxes = [box + [cl] for box, cl in zip(np.stack([x, y, w, h], axis=1).tolist(), cls.tolist())]
+    return boxes, cls
+
+def load_sample(img_path, labels_dir):
+    with open(img_path, 'rb') as fin: image_data = fin.read()
+    label_path = img2label(img_path, labels_dir)
+    return (image_data, label_path) + parse_labels(label_path)
+
+def load_samples(executor, img_paths, labels_dir, max_pending):
+    # Yields (img_path, future) in order, keeping at most max_pending samples in flight to bound memory
+    pending = deque()
+    for img_path in img_paths:
+        pending.append((img_path, executor.submit(load_sample, img_path, labels_dir)))
+        if len(pending) >= max_pending:
+            yield pending.popleft()
+    while pending:
+        yield pending.popleft()
 
 parser = argparse.ArgumentParser(description='Convert a YOLO dataset to an LMDB.')
 parser.add_argument('yaml_path', help="the path to the dataset's YAML file")
@@ -31,6 +70,9 @@ parser.add_argument('lmdb_path', help="the path where the lmdb dataset will be c
 parser.add_argument('--source', default='', help="a string describing the dataset's source")
 parser.add_argument('--ignore-empty', action='store_true')
 parser.add_argument('--overwrite', action='store_true')
+parser.add_argument('--no-sync', action='store_true', help="flush the LMDB to disk once at the end instead of on every commit (faster, but a system crash during the conversion may leave a corrupted dataset)")
+parser.add_argument('--workers', type=int, default=os.cpu_count(), help="the number of threads reading images and labels")
+parser.add_argument('--batch-size', type=int, default=1000, help="the number of images written in each LMDB transaction")
 
 args = parser.parse_args()
 
@@ -98,56 +140,35 @@ for set_ in sets:
         exit(-1)
 
 for set_ in sets:
-    img_paths = list(imgs_paths[set_].glob('*'))
+    try:
+        labels_dir = imgs_dir2labels_dir(imgs_paths[set_])
+    except ValueError:
+        print(f'ERROR: the {set_} images path does not contain an "images" directory, so its labels cannot be found, exiting.')
+        exit(-1)
+    # DirEntry objects cache the file type read with the directory (so is_dir() needs no stat) and can be opened like paths
+    with os.scandir(imgs_paths[set_]) as entries:
+        img_paths = [e for e in entries if os.path.splitext(e.name)[1][1:].lower() in IMG_FORMATS_SET and not e.is_dir()]
     warnings = []
-    with LmdbDataset(str(lmdb_path.joinpath(set_).absolute().as_posix())) as dataset:
-        for img_path in tqdm(img_paths, desc=f'{set_} set progress', ):
-            if img_path.is_dir():
-                continue
-            if not img_path.suffix[1:] in IMG_FORMATS:
-                continue
-
-            with img_path.open(mode='rb') as fin: image_data = fin.read()
-            
-            label_path = img2label(img_path)
-            with label_path.open() as fl:
-                data = fl.readlines()
-            
-            boxes = []
-
-            for dt in data:
-
-                # Split string to float
-                cl, xc, yc, w, h = map(float, dt.split(' '))
-                try:
-                    cl = int(cl)
-                except:
-                    print(f'ERROR: could not parse class as integer in file {label_path.name}, exiting.')
-                    exit(-1)
-                
-                if cl >= nc:
-                    warnings.append(f'WARNING: found class number {cl} in annotation file {label_path.name} which exceeds or is equal to the number of classes {nc} specified in the YAML file.')
-
-                x = (xc - w / 2)
-                y = (yc - h / 2)
-
-                if x < 0:
-                    x = 0
-                if y < 0:
-                    y = 0
-                if x > 1:
-                    x = 1
-                if y > 1:
-                    y = 1
-
-                boxes.append([x, y, w, h, cl])
+    with LmdbDataset(str(lmdb_path.joinpath(set_).absolute().as_posix()), noSync=args.no_sync) as dataset, \
+         ThreadPoolExecutor(max_workers=args.workers) as executor, \
+         dataset.batch(maxItems=args.batch_size, maxBytes=64 * 1024 * 1024):
+        # Images and labels are read by the thread pool while this thread writes them,
+        # committing every args.batch_size images or 64 MiB of images, whichever comes first
+        for img_path, sample in tqdm(load_samples(executor, img_paths, labels_dir, 4 * args.workers), total=len(img_paths), desc=f'{set_} set progress', ):
+            try:
+                image_data, label_path, boxes, cls = sample.result()
+            except ValueError as e:
+                print(f'ERROR: could not parse the annotation file of {img_path.name} ({e}), exiting.')
+                exit(-1)
+
+            for cl in cls[cls >= nc].tolist():
+                warnings.append(f'WARNING: found class number {cl} in annotation file {label_path.name} which exceeds or is equal to the number of classes {nc} specified in the YAML file.')
             
             try:
                 dataset.storeDataJsonPair(img_path.name, image_data, { "boxes": boxes, "source": args.source })
             except Exception as e:
                 if args.overwrite:
                     try:
-                        print('TODO: Check if keys.json is correct')
                         dataset.delete(img_path.name)
                         dataset.storeDataJsonPair(img_path.name, image_data, { "boxes": boxes, "source": args.source })
                     except Exception as e: